@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the pauses of the cyclic garbage collector once a large state is
+loaded, with and without the gc_freeze option of TodoistAPI (which needs
+Python 3.7+), and how many objects are left for the collector to free when
+the api is dropped.
+
+Usage: python benchmarks/gc_pause.py [items]
+"""
+from __future__ import print_function
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from todoist.api import TodoistAPI
+
+from update_state import make_items
+
+
+def full_collection():
+    t0 = timeit.default_timer()
+    gc.collect()
+    return timeit.default_timer() - t0
+
+
+def bench(cache, gc_freeze):
+    api = TodoistAPI('token', cache=cache, gc_freeze=gc_freeze)
+    pause = min(full_collection() for _ in range(5))
+    if hasattr(gc, 'unfreeze'):
+        gc.unfreeze()
+    del api
+    return pause, gc.collect()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    cache = tempfile.mkdtemp() + os.sep
+    try:
+        api = TodoistAPI('token', cache=cache)
+        api._update_state({'items': make_items(count)})
+        api.sync_token = 'token'
+        api._write_cache()
+        del api
+        gc.collect()
+
+        print('%12s %16s %12s' % ('gc_freeze', 'full gc (ms)', 'garbage'))
+        for gc_freeze in (False, True):
+            pause, garbage = bench(cache, gc_freeze)
+            print('%12s %16.2f %12d' % (gc_freeze, pause * 1e3, garbage))
+    finally:
+        shutil.rmtree(cache)
+
+
+if __name__ == '__main__':
+    main()
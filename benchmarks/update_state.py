@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long TodoistAPI._update_state takes to merge sync payloads of
+growing sizes, both into an empty state (first sync) and into a populated one
+(incremental sync updating and deleting a tenth of the objects).  The time
+per object should stay flat as the payload grows.
+
+The items are generated twice: with ascending orders and no due dates, and
+with random due dates and orders, which are inserted all over the indexes
+sorted by them.
+
+Usage: python benchmarks/update_state.py [max_items]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+import timeit
+
+from todoist.api import TodoistAPI
+
+
+def make_items(count, start=0, shuffled=False):
+    items = [{'id': start + i,
+              'content': 'Task %d' % i,
+              'project_id': i % 50,
+              'priority': i % 4 + 1,
+              'checked': 0,
+              'labels': [i % 7],
+              'indent': 1,
+              'item_order': i,
+              'is_deleted': 0}
+             for i in range(count)]
+    if shuffled:
+        rand = random.Random(start)
+        now = time.time()
+        for item in items:
+            item['item_order'] = rand.randrange(count)
+            due = now + rand.randrange(-30, 365) * 86400
+            item['due_date_utc'] = time.strftime('%a %d %b %Y %H:%M:%S +0000',
+                                                 time.gmtime(due))
+    return items
+
+
+def bench(count, shuffled):
+    api = TodoistAPI(cache=None)
+    payload = {'items': make_items(count, shuffled=shuffled)}
+    t0 = timeit.default_timer()
+    api._update_state(payload)
+    full = timeit.default_timer() - t0
+
+    changes = make_items(count // 10, shuffled=shuffled)
+    for obj in changes[::2]:
+        obj['is_deleted'] = 1
+    t0 = timeit.default_timer()
+    api._update_state({'items': changes})
+    partial = timeit.default_timer() - t0
+    return full, partial
+
+
+def main():
+    max_items = int(sys.argv[1]) if len(sys.argv) > 1 else 64000
+    for shuffled in (False, True):
+        print('random due dates and orders' if shuffled else 'ascending orders')
+        print('%10s %12s %14s %12s %14s' % ('items', 'full (s)', 'us/object',
+                                            'delta (s)', 'us/object'))
+        count = 1000
+        while count <= max_items:
+            full, partial = bench(count, shuffled)
+            print('%10d %12.4f %14.2f %12.4f %14.2f' % (
+                count, full, full / count * 1e6,
+                partial, partial / (count // 10) * 1e6))
+            count *= 2
+
+
+if __name__ == '__main__':
+    main()
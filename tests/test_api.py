@@ -1,7 +1,11 @@
 import io
+import os
+import json
 import time
 import datetime
 
+import pytest
+
 import todoist
 
 
@@ -21,6 +25,11 @@ def test_query(cleanup, api_endpoint, api_token):
     inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
     item1 = api.items.add('Item1', inbox['id'], date_string='tomorrow')
     item2 = api.items.add('Item2', inbox['id'], priority=4)
+    # Items added locally have no checked field until they are synced
+    assert item2 in api.items.select(priority=4, checked=0)
+    assert item2 in api.items.query('p1')
+    assert api.items.columns().count(priority=4, checked=0) == \
+        len(api.items.select(priority=4, checked=0))
     api.commit()
 
     response = api.query(['tomorrow', 'p1'])
@@ -32,11 +41,218 @@ def test_query(cleanup, api_endpoint, api_token):
             assert 'Item1' not in [p['content'] for p in query['data']]
             assert 'Item2' in [p['content'] for p in query['data']]
 
+    assert item1 in api.items.query('tomorrow')
+    assert item2 not in api.items.query('tomorrow')
+    assert item2 in api.items.query('p1')
+    assert item1 not in api.items.query('p1')
+    assert item2 in api.items.query('p1 & #Inbox')
+    assert item1 in api.items.query('tomorrow | p1')
+
     item1.delete()
     item2.delete()
     api.commit()
 
 
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'sharded', 'binary'])
+def test_cache(cleanup, tmpdir, backend, api_endpoint, api_token):
+    cache = str(tmpdir) + '/'
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                 cache_backend=backend)
+    api.sync()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    api.commit()
+    datatypes = sorted(api._state_datatypes)
+    if backend == 'json':
+        # The changes of the commit were appended to the journal
+        assert os.path.getsize(cache + api_token + '.journal') > 0
+
+    api2 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                  cache_backend=backend)
+    if backend == 'sharded':
+        # Each datatype is only loaded when first used
+        assert 'items' in api2.state.pending
+    assert api2.sync_token == api.sync_token
+    assert api2.digest(datatypes) == api.digest(datatypes)
+    if backend == 'sharded':
+        assert not api2.state.pending
+    assert sorted(i['id'] for i in api2.state['items']) == \
+        sorted(i['id'] for i in api.state['items'])
+    assert sorted(p['id'] for p in api2.state['projects']) == \
+        sorted(p['id'] for p in api.state['projects'])
+    assert item1['id'] in [i['id'] for i in api2.state['items']]
+
+    item1.delete()
+    api.commit()
+    api2.sync()
+    assert item1['id'] not in [i['id'] for i in api2.state['items']]
+    assert api2.digest(datatypes) == api.digest(datatypes)
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'sharded', 'binary'])
+def test_cache_write_delay(cleanup, tmpdir, backend, api_endpoint, api_token):
+    cache = str(tmpdir) + '/'
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                 cache_backend=backend, write_delay=60)
+    api.sync()
+    api.flush_cache()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    api.commit()
+    item2 = api.items.add('Item2', inbox['id'])
+    api.commit()
+    api.flush_cache()
+    if backend == 'json':
+        # Both commits were merged into a single entry of the journal
+        with open(cache + api_token + '.journal') as f:
+            assert len(f.readlines()) == 1
+    datatypes = sorted(api._state_datatypes)
+
+    api2 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                  cache_backend=backend, write_delay=0.1)
+    assert api2.sync_token == api.sync_token
+    assert api2.digest(datatypes) == api.digest(datatypes)
+    assert item1['id'] in [i['id'] for i in api2.state['items']]
+    assert item2['id'] in [i['id'] for i in api2.state['items']]
+
+    api2.items.get_by_id(item1['id']).delete()
+    api2.commit()
+    time.sleep(0.5)
+    api3 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                  cache_backend=backend)
+    assert api3.sync_token == api2.sync_token
+    assert item1['id'] not in [i['id'] for i in api3.state['items']]
+
+    api2.items.get_by_id(item2['id']).delete()
+    api2.commit()
+    api2.flush_cache()
+
+
+def test_convert_json_cache(cleanup, tmpdir, api_endpoint, api_token):
+    cache = str(tmpdir) + '/'
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache)
+    api.sync()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    api.commit()
+    # An incomplete entry, as left by an interrupted write
+    with open(cache + api_token + '.journal', 'a') as f:
+        f.write('{"sync_token"')
+    files = {}
+    for ext in ('.json', '.sync', '.journal'):
+        with open(cache + api_token + ext) as f:
+            files[ext] = f.read()
+
+    filename = todoist.cache.convert_json_cache(api_token, cache)
+    assert filename == cache + api_token + '.bin'
+    for ext, content in files.items():
+        with open(cache + api_token + ext) as f:
+            assert f.read() == content
+
+    api2 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                  cache_backend='binary')
+    assert api2.sync_token == api.sync_token
+    assert item1['id'] in [i['id'] for i in api2.state['items']]
+
+    item1.delete()
+    api.commit()
+
+
+def test_cache_backend_unknown(api_endpoint, api_token, tmpdir):
+    with pytest.raises(ValueError):
+        todoist.api.TodoistAPI(api_token, api_endpoint, cache=str(tmpdir),
+                               cache_backend='unknown')
+
+
+def test_cache_deserialize(cleanup, monkeypatch, tmpdir, api_endpoint, api_token):
+    # deserialize() uses the default cache directory, in the home directory
+    monkeypatch.setenv('HOME', str(tmpdir))
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=None)
+    api.sync()
+
+    api2 = todoist.api.TodoistAPI.deserialize(api.serialize())
+    inbox = [p for p in api2.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api2.items.add('Item1', inbox['id'])
+    api2.commit()
+    cache = os.path.join(str(tmpdir), '.todoist-sync', '')
+    assert os.path.exists(cache + api_token + '.json')
+    assert not os.path.exists(cache + '.json')
+
+    api3 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache)
+    assert api3.sync_token == api2.sync_token
+    assert item1['id'] in [i['id'] for i in api3.state['items']]
+
+    item1.delete()
+    api2.commit()
+
+
+def test_tiering(cleanup, tmpdir, api_endpoint, api_token):
+    cache = str(tmpdir) + '/'
+    policy = todoist.tiers.TierPolicy()
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                 tiering=policy)
+    api.sync()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    item2 = api.items.add('Item2', inbox['id'])
+    api.commit()
+    item1.complete()
+    api.commit()
+    # The completed item was moved to the cold tier
+    assert item1['id'] not in [i['id'] for i in api.state['items']]
+    assert item2['id'] in [i['id'] for i in api.state['items']]
+    assert item1['id'] in [i['id'] for i in api.items.all()]
+    usage = api.memory_usage()['items']
+    assert usage['cold_objects'] == 1
+    assert usage['objects'] == len(api.state['items'])
+
+    # The cache still holds the objects in the cold tier
+    api2 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache)
+    assert item1['id'] in [i['id'] for i in api2.state['items']]
+    assert item2['id'] in [i['id'] for i in api2.state['items']]
+
+    api3 = todoist.api.TodoistAPI(api_token, api_endpoint, cache=cache,
+                                  tiering=policy)
+    assert item1['id'] not in [i['id'] for i in api3.state['items']]
+    assert api3.memory_usage()['items']['cold_objects'] == 1
+    assert api3.items.get_by_id(item1['id'])['content'] == 'Item1'
+    assert item1['id'] in [i['id'] for i in api3.state['items']]
+    assert api3.memory_usage()['items']['cold_objects'] == 0
+
+    api.items.delete([item1['id'], item2['id']])
+    api.commit()
+
+
+def test_serialize(cleanup, monkeypatch, tmpdir, api_endpoint, api_token):
+    # deserialize() uses the default cache directory, in the home directory
+    monkeypatch.setenv('HOME', str(tmpdir))
+    api = todoist.api.TodoistAPI(api_token, api_endpoint, cache=None)
+    api.sync()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    api.commit()
+    item2 = api.items.add('Item2', inbox['id'])
+    temp_id = item2['id']
+
+    data = json.loads(json.dumps(api.serialize(),
+                                 default=todoist.cache.state_default))
+    api2 = todoist.api.TodoistAPI.deserialize(data)
+    assert api2.items.get_by_id(item1['id'])['content'] == 'Item1'
+    item2_copy = api2.items.get_by_id(temp_id)
+    assert item2_copy['content'] == 'Item2'
+
+    # The queue is not serialized
+    api2.queue.extend(json.loads(json.dumps(api.queue)))
+    api2.commit()
+    assert item2_copy['id'] != temp_id
+    assert api2.temp_ids[temp_id] == item2_copy['id']
+    assert api2.items.get_by_id(item2_copy['id']) is item2_copy
+    assert api2.items.get_by_id(temp_id) is item2_copy
+
+    api2.items.delete([item1['id'], item2_copy['id']])
+    api2.commit()
+
+
 def test_user(api_endpoint, api_token):
     api = todoist.api.TodoistAPI(api_token, api_endpoint)
     api.sync()
@@ -104,6 +320,7 @@ def test_project(cleanup, api_endpoint, api_token):
     assert response['projects'][0]['id'] == project1['id']
     assert response['projects'][0]['is_deleted'] == 1
     assert 'UpdatedProject1' not in [p['name'] for p in api.state['projects']]
+    assert project1 in api.changes.deleted('projects')
 
     api.projects.archive(project2['id'])
     response = api.commit()
@@ -149,11 +366,14 @@ def test_item(cleanup, api_endpoint, api_token):
     assert response['items'][0]['content'] == 'Item1'
     assert 'Item1' in [i['content'] for i in api.state['items']]
     assert api.items.get_by_id(item1['id']) == item1
+    assert api.items.columns().select(id=item1['id']) == [item1]
 
+    snapshot = api.digest_snapshot(['items'])
     item1.complete()
     response = api.commit()
     assert response['items'][0]['content'] == 'Item1'
     assert response['items'][0]['checked'] == 1
+    assert api.compare_digest(snapshot)['items']['updated'] == [str(item1['id'])]
     assert 1 in [i['checked'] for i in api.state['items'] if i['id'] == item1['id']]
 
     item1.uncomplete()
@@ -170,12 +390,15 @@ def test_item(cleanup, api_endpoint, api_token):
     assert response['items'][0]['content'] == 'Item1'
     assert response['items'][0]['project_id'] == project1['id']
     assert project1['id'] in [i['project_id'] for i in api.state['items'] if i['id'] == item1['id']]
+    assert item1 in api.items.by_project(project1['id'])
+    assert item1 not in api.items.by_project(inbox['id'])
 
     item1.update(content='UpdatedItem1')
     response = api.commit()
     assert response['items'][0]['content'] == 'UpdatedItem1'
     assert 'UpdatedItem1' in [i['content'] for i in api.state['items']]
     assert api.items.get_by_id(item1['id']) == item1
+    assert item1 in api.items.search('updateditem')
 
     date_string = datetime.datetime(2038, 1, 19, 3, 14, 7)
     item2 = api.items.add('Item2', inbox['id'], date_string=date_string)
@@ -253,6 +476,48 @@ def test_item(cleanup, api_endpoint, api_token):
     response = api.commit()
 
 
+def test_item_tree(cleanup, api_endpoint, api_token):
+    api = todoist.api.TodoistAPI(api_token, api_endpoint)
+
+    api.sync()
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    project1 = api.projects.add('Project1')
+    item1 = api.items.add('Item1', inbox['id'])
+    item2 = api.items.add('Item2', inbox['id'])
+    item3 = api.items.add('Item3', inbox['id'])
+    item4 = api.items.add('Item4', inbox['id'])
+    api.commit()
+
+    api.items.update_orders_indents({item1['id']: [1, 1], item2['id']: [2, 2],
+                                     item3['id']: [3, 3], item4['id']: [4, 1]})
+    api.commit()
+    assert api.items.get_roots(inbox['id']) == [item1, item4]
+    assert api.items.get_parent(item1['id']) is None
+    assert api.items.get_parent(item2['id']) == item1
+    assert api.items.get_parent(item3['id']) == item2
+    assert api.items.get_children(item1['id']) == [item2]
+    assert api.items.get_children(item4['id']) == []
+    assert api.items.get_descendants(item1['id']) == [item2, item3]
+
+    api.items.update_orders_indents({item3['id']: [3, 2]})
+    api.commit()
+    assert api.items.get_parent(item3['id']) == item1
+    assert api.items.get_children(item1['id']) == [item2, item3]
+    assert api.items.get_descendants(item2['id']) == []
+
+    item2.move(project1['id'])
+    api.commit()
+    assert api.items.get_roots(project1['id']) == [item2]
+    assert api.items.get_parent(item2['id']) is None
+    assert api.items.get_children(item1['id']) == [item3]
+    assert api.items.get_roots(inbox['id']) == [item1, item4]
+
+    api.items.delete([item1['id'], item2['id'], item3['id'], item4['id']])
+    api.commit()
+    project1.delete()
+    api.commit()
+
+
 def test_label(cleanup, api_endpoint, api_token):
     api = todoist.api.TodoistAPI(api_token, api_endpoint)
 
@@ -405,6 +670,20 @@ def test_filter(cleanup, api_endpoint, api_token):
     assert 'Filter1' in [f['name'] for f in api.state['filters']]
     assert api.filters.get_by_id(filter1['id']) == filter1
 
+    view = api.filters.view(filter1['id'])
+    assert api.filters.view(filter1['id']) is view
+    events = []
+    view.subscribe(lambda added, removed: events.append((added, removed)))
+    inbox = [p for p in api.state['projects'] if p['name'] == 'Inbox'][0]
+    item1 = api.items.add('Item1', inbox['id'])
+    api.commit()
+    assert item1 in view.items()
+    assert any(item1 in added for added, _ in events)
+    item1.delete()
+    api.commit()
+    assert item1 not in view.items()
+    assert any(item1 in removed for _, removed in events)
+
     filter1.update(name='UpdatedFilter1')
     response = api.commit()
     assert response['filters'][0]['name'] == 'UpdatedFilter1'
@@ -429,6 +708,8 @@ def test_filter(cleanup, api_endpoint, api_token):
     assert response['filters'][0]['id'] == filter1['id']
     assert response['filters'][0]['is_deleted'] == 1
     assert 'UpdatedFilter1' not in [p['name'] for p in api.state['filters']]
+    # The view of the filter is no longer kept up to date
+    assert view not in api.items._watchers
 
     api.filters.update(filter2['id'], name='UpdatedFilter2')
     response = api.commit()
@@ -495,6 +776,32 @@ def test_reminder(cleanup, api_endpoint, api_token):
     assert response['reminders'][0]['is_deleted'] == 1
     assert reminder2['id'] not in [p['id'] for p in api.state['reminders']]
 
+    # location
+    reminder3 = api.reminders.add(item1['id'], type='location', name='Paris',
+                                  loc_lat='48.8566', loc_long='2.3522',
+                                  loc_trigger='on_enter', radius=100)
+    api.commit()
+    # Far away from the only location reminder
+    start = time.time()
+    assert api.reminders.nearest(40.7128, -74.0060) == [reminder3]
+    assert api.reminders.near(40.7128, -74.0060, 1000) == []
+    assert time.time() - start < 1
+
+    reminder4 = api.reminders.add(item1['id'], type='location',
+                                  name='Versailles', loc_lat='48.8049',
+                                  loc_long='2.1204', loc_trigger='on_enter',
+                                  radius=100)
+    api.commit()
+    # Versailles is about 18 km away from Paris
+    assert api.reminders.near(48.8566, 2.3522, 10000) == [reminder3]
+    assert api.reminders.near(48.8566, 2.3522, 20000) == [reminder3, reminder4]
+    assert api.reminders.nearest(48.8049, 2.1204, 2) == [reminder4, reminder3]
+
+    api.reminders.delete(reminder3['id'])
+    api.reminders.delete(reminder4['id'])
+    api.commit()
+    assert api.reminders.nearest(48.8566, 2.3522) == []
+
     item1.delete()
     response = api.commit()
 
@@ -509,6 +816,19 @@ def test_locations(api_endpoint, api_token):
 
     assert api.state['locations'] == []
 
+    # The locations are only ever replaced by syncs
+    paris = ['Paris', '48.8566', '2.3522']
+    versailles = ['Versailles', '48.8049', '2.1204']
+    api.state['locations'] = [paris, versailles]
+    start = time.time()
+    # Versailles lies west of Paris
+    assert api.locations.nearest(40.7128, -74.0060) == [versailles]
+    assert api.locations.near(40.7128, -74.0060, 1000) == []
+    assert time.time() - start < 1
+    assert api.locations.near(48.8566, 2.3522, 10000) == [paris]
+    assert api.locations.near(48.8566, 2.3522, 20000) == [paris, versailles]
+    assert api.locations.nearest(48.8049, 2.1204, 2) == [versailles, paris]
+
 
 def test_live_notifications(api_endpoint, api_token):
     api = todoist.api.TodoistAPI(api_token, api_endpoint)
@@ -554,6 +874,12 @@ def test_share(cleanup, cleanup2, api_endpoint, api_token, api_token2):
         [p['user_id'] for p in response2['collaborator_states']]
     assert api2.state['user']['id'] in \
         [p['user_id'] for p in response2['collaborator_states']]
+    assert api2.collaborator_states.get_by_ids(
+        project1['id'], api2.state['user']['id'])['state'] == 'active'
+    assert api2.state['user']['id'] in \
+        [p['user_id'] for p in api2.collaborator_states.get_by_project(project1['id'])]
+    assert project1['id'] in \
+        [p['project_id'] for p in api2.collaborator_states.get_by_user(api.state['user']['id'])]
 
     response = api.sync()
     invitation1resp = [ln for ln in response['live_notifications'] if 'invitation_id' in ln][0]
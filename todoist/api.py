@@ -1,11 +1,17 @@
+import gc
 import os
 import uuid
 import json
+import collections
 import requests
 import datetime
 import functools
 
 from todoist import models
+from todoist.cache import BACKENDS, CacheWriter, LazyState, atomic_write, interned_object
+from todoist.changes import ChangeSet, changed_fields
+from todoist.indexes import string_types
+from todoist.tiers import TieredStorage, object_size
 from todoist.managers.biz_invitations import BizInvitationsManager
 from todoist.managers.filters import FiltersManager
 from todoist.managers.invitations import InvitationsManager
@@ -33,6 +39,31 @@ class SyncError(Exception):
     pass
 
 
+def _is_temp_id(value):
+    """
+    Returns whether an id is a temporary one, generated locally, rather than
+    a real one, which is a number.
+    """
+    return isinstance(value, string_types) and not value.isdigit()
+
+
+class TempIdMapping(collections.OrderedDict):
+    """
+    Mapping of temporary ids to real ids, which only remembers the most
+    recently added entries, evicting the oldest ones.
+    """
+    def __init__(self, data=(), maxlen=10000):
+        self.maxlen = maxlen
+        collections.OrderedDict.__init__(self, data)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        collections.OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.maxlen:
+            self.popitem(last=False)
+
+
 class TodoistAPI(object):
     """
     Implements the API that makes it possible to interact with a Todoist user
@@ -40,24 +71,66 @@ class TodoistAPI(object):
     """
     _serialize_fields = ('token', 'api_endpoint', 'sync_token', 'state', 'temp_ids')
 
+    # Types of objects in the local state which are wrapped in models, each
+    # one of them being kept by the manager with the same name.
+    _state_models = (
+        ('collaborators', models.Collaborator),
+        ('collaborator_states', models.CollaboratorState),
+        ('filters', models.Filter),
+        ('items', models.Item),
+        ('labels', models.Label),
+        ('live_notifications', models.LiveNotification),
+        ('notes', models.Note),
+        ('project_notes', models.ProjectNote),
+        ('projects', models.Project),
+        ('reminders', models.Reminder),
+    )
+    _state_datatypes = frozenset(datatype for datatype, _ in _state_models)
+    _model_datatypes = dict((model, datatype) for datatype, model in _state_models)
+    _datatype_models = dict(_state_models)
+
     @classmethod
     def deserialize(cls, data):
         obj = cls()
         for key in cls._serialize_fields:
             if key in data:
                 setattr(obj, key, data[key])
+        obj.temp_ids = TempIdMapping(obj.temp_ids)
+        for datatype, model in cls._state_models:
+            # The state may have been decoded from JSON, in which case it
+            # holds the data of the objects rather than the objects.
+            localobjs = obj.state.setdefault(datatype, [])
+            localobjs[:] = [localobj if isinstance(localobj, models.Model)
+                            else model(localobj, obj) for localobj in localobjs]
+            for localobj in localobjs:
+                temp_id = localobj.temp_id or localobj.data.get('id')
+                if _is_temp_id(temp_id) and localobj.data.get('id') == temp_id:
+                    # Created locally, and still waiting for its real id
+                    localobj.temp_id = temp_id
+                    obj._temp_id_objects[temp_id] = localobj
+            getattr(obj, datatype)._rebuild_index()
         return obj
 
     def __init__(self,
                  token='',
                  api_endpoint='https://todoist.com',
                  session=None,
-                 cache='~/.todoist-sync/'):
+                 cache='~/.todoist-sync/',
+                 search_budget=None,
+                 gc_freeze=False,
+                 tiering=None,
+                 journal=True,
+                 cache_backend='json',
+                 write_delay=None):
         self.api_endpoint = api_endpoint
-        self.reset_state()
+        self.search_budget = search_budget  # Max postings of each text index
+        self.gc_freeze = gc_freeze  # Freeze the state after loading it
+        self.journal = journal  # Append the changes of each sync to the cache
         self.token = token  # User's API token
-        self.temp_ids = {}  # Mapping of temporary ids to real ids
+        self.temp_ids = TempIdMapping()  # Mapping of temporary ids to real ids
         self.queue = []  # Requests to be sent are appended here
+        self.changes = ChangeSet()  # Changes made by the last sync
+        self._change_listeners = []
         self.session = session or requests.Session()  # Session instance for requests
 
         # managers
@@ -85,13 +158,36 @@ class TodoistAPI(object):
         self.quick = QuickManager(self)
         self.emails = EmailsManager(self)
 
+        self.tiers = None  # Cold tier of the local state, see TierPolicy
+        self.reset_state()
+
+        if isinstance(cache_backend, string_types):
+            if cache_backend not in BACKENDS:
+                raise ValueError('unknown cache backend: %r' % cache_backend)
+            cache_backend = BACKENDS[cache_backend]
         if cache:  # Read and write user state on local disk cache
             self.cache = os.path.expanduser(cache)
-            self._read_cache()
+            # Backend storing the state in the cache, see todoist.cache
+            self.cache_backend = None
+            self._read_cache(cache_backend)
         else:
             self.cache = None
+            self.cache_backend = None
+        # Writes the cache in a background thread, once there was no sync for
+        # write_delay seconds, if given
+        self.cache_writer = None
+        if self.cache_backend and write_delay is not None:
+            self.cache_writer = CacheWriter(self.cache_backend, write_delay)
+
+        if tiering is not None:
+            if not self.cache:
+                raise ValueError('tiering needs a cache directory')
+            self.tiers = TieredStorage(self, tiering, self.cache + self.token + '.cold')
+            self.tiers.apply()
 
     def reset_state(self):
+        if isinstance(self.__dict__.get('state'), LazyState):
+            self.state.discard()
         self.sync_token = '*'
         self.state = {  # Local copy of all of the user's objects
             'collaborator_states': [],
@@ -111,21 +207,110 @@ class TodoistAPI(object):
             'settings_notifications': {},
             'user': {},
         }
+        self._temp_id_objects = {}  # Objects created locally, by temporary id
+        for datatype, _ in self._state_models:
+            getattr(self, datatype)._reset_index()
+        if self.tiers is not None:
+            self.tiers.clear()
 
     def __getitem__(self, key):
         return self.state[key]
 
+    def __getattr__(self, name):
+        # The managers of the objects still to be loaded from the cache are
+        # set aside until first used, see todoist.cache.LazyState.
+        state = self.__dict__.get('state')
+        if isinstance(state, LazyState) and name in state.pending:
+            state.load(name)
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def serialize(self):
         return {key: getattr(self, key) for key in self._serialize_fields}
 
     def get_api_url(self):
         return '%s/API/v7/' % self.api_endpoint
 
+    def add_change_listener(self, callback):
+        """
+        Registers a function which is called with the ChangeSet of every
+        update of the local state with data from the server.
+        """
+        self._change_listeners.append(callback)
+
+    def remove_change_listener(self, callback):
+        self._change_listeners.remove(callback)
+
+    def memory_usage(self):
+        """
+        Returns, for each type of objects of the local state, the number of
+        them in memory and in the cold tier, and the estimated memory used by
+        the ones in memory, in bytes.
+        """
+        if self.tiers is not None:
+            return self.tiers.memory_usage()
+        return dict((datatype, {'objects': len(self.state[datatype]),
+                                'bytes': sum(object_size(obj.data)
+                                             for obj in self.state[datatype]),
+                                'cold_objects': 0})
+                    for datatype, _ in self._state_models)
+
+    def digest(self, datatypes=None):
+        """
+        Returns the root hash of the contents of each type of data of the
+        local state (or of the types given), which changes whenever anything
+        in it changes.
+        """
+        digests = {}
+        for datatype in datatypes or self.state:
+            if datatype in self._state_datatypes:
+                digests[datatype] = getattr(self, datatype)._indexes['digest'].root()
+            else:
+                digests[datatype] = '%016x' % models.content_hash(self.state[datatype])
+        return digests
+
+    def digest_snapshot(self, datatypes=None):
+        """
+        Returns the hashes of the contents of the local state, in a form that
+        can be stored as JSON, and later passed to compare_digest().
+        """
+        snapshot = {}
+        for datatype in datatypes or self.state:
+            if datatype in self._state_datatypes:
+                snapshot[datatype] = getattr(self, datatype)._indexes['digest'].snapshot()
+            else:
+                snapshot[datatype] = self.digest([datatype])[datatype]
+        return snapshot
+
+    def compare_digest(self, snapshot):
+        """
+        Compares the local state with a snapshot returned by
+        digest_snapshot(), and returns the keys of the objects added, updated
+        and deleted since, by type of data, leaving out the types of data
+        which did not change.  For the rest of the data, True is given if it
+        changed.  Only the objects whose hashes fall in the same bucket as
+        one of the changes are looked at.
+        """
+        changes = {}
+        for datatype, old in snapshot.items():
+            if datatype in self._state_datatypes:
+                added, updated, deleted = \
+                    getattr(self, datatype)._indexes['digest'].diff(old)
+                if added or updated or deleted:
+                    changes[datatype] = {'added': added, 'updated': updated,
+                                         'deleted': deleted}
+            elif self.digest([datatype])[datatype] != old:
+                changes[datatype] = True
+        return changes
+
     def _update_state(self, syncdata):
         """
         Updates the local state, with the data returned by the server after a
-        sync.
+        sync, and returns the changes that were made, which are also kept in
+        the changes attribute.
         """
+        changes = ChangeSet()
+
         # Check sync token first
         if 'sync_token' in syncdata:
             self.sync_token = syncdata['sync_token']
@@ -133,63 +318,85 @@ class TodoistAPI(object):
         # It is straightforward to update these type of data, since it is
         # enough to just see if they are present in the sync data, and then
         # either replace the local values or update them.
-        if 'day_orders' in syncdata:
-            self.state['day_orders'].update(syncdata['day_orders'])
-        if 'day_orders_timestamp' in syncdata:
-            self.state['day_orders_timestamp'] = syncdata['day_orders_timestamp']
-        if 'live_notifications_last_read_id' in syncdata:
-            self.state['live_notifications_last_read_id'] = syncdata['live_notifications_last_read_id']
-        if 'locations' in syncdata:
-            self.state['locations'] = syncdata['locations']
-        if 'settings_notifications' in syncdata:
-            self.state['settings_notifications'].update(syncdata['settings_notifications'])
-        if 'user' in syncdata:
-            self.state['user'].update(syncdata['user'])
+        for datatype in ('day_orders', 'settings_notifications', 'user'):
+            if datatype in syncdata:
+                fields = changed_fields(self.state[datatype], syncdata[datatype])
+                if fields:
+                    self.state[datatype].update(syncdata[datatype])
+                    changes.add(datatype, 'updated', self.state[datatype], fields)
+        for datatype in ('day_orders_timestamp', 'live_notifications_last_read_id',
+                         'locations'):
+            if datatype in syncdata and syncdata[datatype] != self.state[datatype]:
+                self.state[datatype] = syncdata[datatype]
+                changes.add(datatype, 'updated', self.state[datatype])
 
         # Updating these type of data is a bit more complicated, since it is
         # necessary to find out whether an object in the sync data is new,
         # updates an existing object, or marks an object to be deleted.  But
         # the same procedure takes place for each of these types of data.
-        resp_models_mapping = [
-            ('collaborators', models.Collaborator),
-            ('collaborator_states', models.CollaboratorState),
-            ('filters', models.Filter),
-            ('items', models.Item),
-            ('labels', models.Label),
-            ('live_notifications', models.LiveNotification),
-            ('notes', models.Note),
-            ('project_notes', models.ProjectNote),
-            ('projects', models.Project),
-            ('reminders', models.Reminder),
-        ]
-        for datatype, model in resp_models_mapping:
-            if datatype not in syncdata:
-                continue
-
-            # Process each object of this specific type in the sync data.
-            for remoteobj in syncdata[datatype]:
-                # Find out whether the object already exists in the local
-                # state.
-                localobj = self._find_object(datatype, remoteobj)
+        for datatype, model in self._state_models:
+            if datatype in syncdata:
+                self._merge_objects(datatype, model, syncdata[datatype], changes)
+
+        # Parse the dates of the objects that were added or updated in one
+        # go, rather than when each one of them is first used.
+        for change in changes:
+            if change.kind != 'deleted' and isinstance(change.obj, models.Model):
+                change.obj.parse_dates()
+
+        if self.tiers is not None:
+            self.tiers.apply()
+
+        self.changes = changes
+        for callback in list(self._change_listeners):
+            callback(changes)
+        return changes
+
+    def _merge_objects(self, datatype, model, remoteobjs, changes):
+        """
+        Merges the objects of a specific type returned by the server into the
+        local state, in a single pass over the sync data, and records what
+        changed.  Deleted objects are only marked while going through the
+        sync data, and then all of them are dropped from the local state in a
+        single pass at the end.
+        """
+        manager = getattr(self, datatype)
+        localobjs = self.state[datatype]
+        deleted = set()
+        for remoteobj in remoteobjs:
+            # Find out whether the object already exists in the local state.
+            localobj = manager._find_local(remoteobj)
+            if localobj is None and self.tiers is not None:
+                localobj = manager._thaw(remoteobj.get('id'))
+            is_deleted = remoteobj.get('is_deleted', 0)
+            if is_deleted == 0 or is_deleted is False:
                 if localobj is not None:
-                    # If the object is already present in the local state, then
-                    # we either update it, or if marked as to be deleted, we
-                    # remove it.
-                    is_deleted = remoteobj.get('is_deleted', 0)
-                    if is_deleted == 0 or is_deleted is False:
-                        localobj.data.update(remoteobj)
-                    else:
-                        self.state[datatype].remove(localobj)
+                    # If the object is already present in the local state,
+                    # then we update it.
+                    fields = changed_fields(localobj.data, remoteobj)
+                    if fields:
+                        manager._update_local(localobj, remoteobj, notify=False)
+                        changes.add(datatype, 'updated', localobj, fields)
                 else:
-                    # If not, then the object is new and it should be added,
-                    # unless it is marked as to be deleted (in which case it's
-                    # ignored).
-                    is_deleted = remoteobj.get('is_deleted', 0)
-                    if is_deleted == 0 or is_deleted is False:
-                        newobj = model(remoteobj, self)
-                        self.state[datatype].append(newobj)
-
-    def _read_cache(self):
+                    # If not, then the object is new and it should be added.
+                    newobj = model(remoteobj, self)
+                    localobjs.append(newobj)
+                    manager._index(newobj)
+                    changes.add(datatype, 'added', newobj)
+            elif localobj is not None:
+                # If marked as to be deleted, we remove it (and if it's not
+                # present locally, then it's just ignored).
+                manager._unindex(localobj)
+                deleted.add(localobj)
+                changes.add(datatype, 'deleted', localobj)
+                if localobj.temp_id:
+                    self._temp_id_objects.pop(localobj.temp_id, None)
+
+        if deleted:
+            localobjs[:] = [obj for obj in localobjs if obj not in deleted]
+        manager._notify_watchers()
+
+    def _read_cache(self, backend):
         if not self.cache:
             return
 
@@ -199,26 +406,79 @@ class TodoistAPI(object):
             if not os.path.isdir(self.cache):
                 raise
 
+        self._read_search_cache()
+        self.cache_backend = backend(self, self.cache)
         try:
-            with open(self.cache + self.token + '.json') as f:
-                state = f.read()
-            state = json.loads(state)
-            self._update_state(state)
-
-            with open(self.cache + self.token + '.sync') as f:
-                sync_token = f.read()
-            self.sync_token = sync_token
+            if not self.cache_backend.load():
+                return
         except:
             return
+        else:
+            self._freeze_state()
+        finally:
+            # The preloaded entries of the objects loaded lazily are cleared
+            # once they are loaded.
+            pending = self.state.pending if isinstance(self.state, LazyState) else ()
+            for manager in self._search_managers(pending):
+                manager._indexes['text'].clear_preloaded()
+
+    def _write_cache(self, changes=None):
+        """
+        Writes the local state to the cache.  Given the changes of the last
+        sync, only what changed since the cache was last written may be
+        written, depending on the backend.
+        """
+        if not self.cache_backend:
+            return
+        if self.cache_writer:
+            self.cache_writer.put(changes)
+        else:
+            self.cache_backend.save(changes)
+        if changes is None:
+            self._write_search_cache()
 
-    def _write_cache(self):
-        if not self.cache:
+    def flush_cache(self):
+        """
+        Waits until the cache is written, if it is written in the background
+        (see write_delay).
+        """
+        if self.cache_writer:
+            self.cache_writer.flush()
+
+    def _freeze_state(self):
+        """
+        If gc_freeze is set, moves all the objects currently alive, most of
+        them being the local state just loaded, out of reach of the cyclic
+        garbage collector (Python 3.7+), so that its collections no longer
+        go through them.  Note that this applies to the whole process.
+        """
+        if self.gc_freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+    def _search_managers(self, exclude=()):
+        return [getattr(self, datatype) for datatype, _ in self._state_models
+                if datatype not in exclude and 'text' in getattr(self, datatype)._indexes]
+
+    def _read_search_cache(self):
+        """
+        Preloads the full-text indexes stored along with the cache, so that
+        the texts which did not change since are not parsed again.
+        """
+        try:
+            with open(self.cache + self.token + '.search') as f:
+                data = json.loads(f.read())
+        except (IOError, OSError, ValueError):
             return
-        result = json.dumps(self.state, indent=2, sort_keys=True, default=state_default)
-        with open(self.cache + self.token + '.json', 'w') as f:
-            f.write(result)
-        with open(self.cache + self.token + '.sync', 'w') as f:
-            f.write(self.sync_token)
+        for manager in self._search_managers():
+            if manager.state_name in data:
+                manager._indexes['text'].preload(data[manager.state_name])
+
+    def _write_search_cache(self):
+        data = dict((manager.state_name, manager._indexes['text'].dump())
+                    for manager in self._search_managers())
+        atomic_write(self.cache + self.token + '.search',
+                     json.dumps(data, separators=(',', ':')))
 
     def _find_object(self, objtype, obj):
         """
@@ -226,28 +486,9 @@ class TodoistAPI(object):
         object, and then on its primary key is.  If the object is found it is
         returned, and if not, then None is returned.
         """
-        if objtype == 'collaborators':
-            return self.collaborators.get_by_id(obj['id'])
-        elif objtype == 'collaborator_states':
-            return self.collaborator_states.get_by_ids(obj['project_id'], obj['user_id'])
-        elif objtype == 'filters':
-            return self.filters.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'items':
-            return self.items.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'labels':
-            return self.labels.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'live_notifications':
-            return self.live_notifications.get_by_id(obj['id'])
-        elif objtype == 'notes':
-            return self.notes.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'project_notes':
-            return self.project_notes.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'projects':
-            return self.projects.get_by_id(obj['id'], only_local=True)
-        elif objtype == 'reminders':
-            return self.reminders.get_by_id(obj['id'], only_local=True)
-        else:
+        if objtype not in self._state_datatypes:
             return None
+        return getattr(self, objtype)._find_local(obj)
 
     def _replace_temp_id(self, temp_id, new_id):
         """
@@ -255,15 +496,14 @@ class TodoistAPI(object):
         created, with a real Id supplied by the server.  True is returned if
         the temporary id was found and replaced, and False otherwise.
         """
-        # Go through all the objects for which we expect the temporary id to be
-        # replaced by a real one.
-        for datatype in ['filters', 'items', 'labels', 'notes', 'project_notes',
-                         'projects', 'reminders']:
-            for obj in self.state[datatype]:
-                if obj.temp_id == temp_id:
-                    obj['id'] = new_id
-                    return True
-        return False
+        obj = self._temp_id_objects.pop(temp_id, None)
+        if obj is None:
+            return False
+        manager = getattr(self, self._model_datatypes[type(obj)])
+        manager._unindex(obj)
+        obj['id'] = new_id
+        manager._index(obj)
+        return True
 
     def _get(self, call, url=None, **kwargs):
         """
@@ -276,7 +516,7 @@ class TodoistAPI(object):
         response = self.session.get(url + call, **kwargs)
 
         try:
-            return response.json()
+            return response.json(object_pairs_hook=interned_object)
         except ValueError:
             return response.text
 
@@ -291,7 +531,7 @@ class TodoistAPI(object):
         response = self.session.post(url + call, **kwargs)
 
         try:
-            return response.json()
+            return response.json(object_pairs_hook=interned_object)
         except ValueError:
             return response.text
 
@@ -315,13 +555,18 @@ class TodoistAPI(object):
             'resource_types': json_dumps(['all']),
             'commands': json_dumps(commands or []),
         }
+        full_sync = self.sync_token == '*'
         response = self._post('sync', data=post_data)
         if 'temp_id_mapping' in response:
             for temp_id, new_id in response['temp_id_mapping'].items():
                 self.temp_ids[temp_id] = new_id
                 self._replace_temp_id(temp_id, new_id)
-        self._update_state(response)
-        self._write_cache()
+        changes = self._update_state(response)
+        if full_sync:
+            self._write_cache()
+            self._freeze_state()
+        elif changes or (self.cache_backend and self.cache_backend.has_changes()):
+            self._write_cache(changes)
         return response
 
     def commit(self, raise_on_error=True):
@@ -333,9 +578,15 @@ class TodoistAPI(object):
         """
         if len(self.queue) == 0:
             return
+        commands = list(self.queue)
         ret = self.sync(commands=self.queue)
         del self.queue[:]
         if 'sync_status' in ret:
+            # The objects whose creation failed will never get a real id.
+            for command in commands:
+                if 'temp_id' in command and \
+                        ret['sync_status'].get(command['uuid'], 'ok') != 'ok':
+                    self._temp_id_objects.pop(command['temp_id'], None)
             if raise_on_error:
                 for k, v in ret['sync_status'].items():
                     if v != 'ok':
@@ -347,7 +598,8 @@ class TodoistAPI(object):
     def query(self, queries, **kwargs):
         """
         DEPRECATED: query endpoint is deprecated for a long time and this
-        method will be removed in the next major version of todoist-python
+        method will be removed in the next major version of todoist-python,
+        use items.query() to evaluate the queries on the local state instead
         """
         params = {'queries': json_dumps(queries),
                   'token': self.token}
@@ -374,10 +626,6 @@ class TodoistAPI(object):
         return '%s%s(%s)' % (name, unsaved, email_repr)
 
 
-def state_default(obj):
-    return obj.data
-
-
 def json_default(obj):
     if isinstance(obj, datetime.datetime):
         return obj.strftime('%Y-%m-%dT%H:%M:%S')
@@ -388,3 +636,4 @@ def json_default(obj):
 
 
 json_dumps = functools.partial(json.dumps, separators=',:', default=json_default)
+
@@ -0,0 +1,952 @@
+# -*- coding: utf-8 -*-
+"""
+Backends which keep the local state on disk between runs, in the cache
+directory of TodoistAPI, and the decoding of the JSON they store.
+
+Each backend follows the changes made to the objects of the local state, so
+that after an incremental sync only the objects added, changed or removed
+since the cache was last written need to be written.
+
+Writing is done in two steps: a snapshot of what has to be written is taken,
+copying the data of the objects, and then written, possibly by a CacheWriter
+in a background thread while the state keeps changing.  Files which are
+written in full are written to a temporary file first, which is then renamed
+over them.
+"""
+import atexit
+import collections
+import functools
+import itertools
+import json
+import marshal
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import traceback
+import weakref
+import zlib
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2
+    ThreadPoolExecutor = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .changes import ChangeSet
+
+try:
+    intern = sys.intern
+except AttributeError:  # Python 2, whose intern() does not accept unicode
+    def intern(value):
+        return value
+
+#: strings up to this length are interned when decoding
+INTERN_MAX_LENGTH = 40
+
+
+def interned_object(pairs):
+    """
+    Builds a decoded JSON object, interning its keys and its short string
+    values, so that the keys and the values repeated across the objects of
+    the state (date strings, colors, names...) are only kept once in memory.
+    """
+    obj = {}
+    for key, value in pairs:
+        if type(value) is str and len(value) <= INTERN_MAX_LENGTH:
+            value = intern(value)
+        obj[intern(key)] = value
+    return obj
+
+
+json_loads = functools.partial(json.loads, object_pairs_hook=interned_object)
+
+
+def state_default(obj):
+    return obj.data
+
+
+state_dumps = functools.partial(json.dumps, separators=(',', ':'), default=state_default)
+
+_replace = getattr(os, 'replace', os.rename)  # Python 2 has no os.replace
+
+
+def atomic_write(path, content, mode='w'):
+    """
+    Writes a file through a temporary file renamed over it, so that the file
+    is either left as it was or completely written, even if the process is
+    interrupted.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, mode) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(temp_path, path)
+
+
+def _copy(value):
+    # The dicts of the state, such as user, are updated in place.
+    return dict(value) if isinstance(value, dict) else value
+
+
+#: what a backend has to write to the cache, and the path of the files of
+#: the token it was taken for; if full, it supersedes the snapshots taken
+#: before it
+Snapshot = collections.namedtuple('Snapshot', 'full data path')
+
+
+class ChangeTracker(object):
+    """
+    Records the keys of the objects of a manager added, changed or removed
+    since the cache was last written, as a watcher of the manager.
+    """
+    # The cache keeps the objects in the cold tier (see TieredStorage).
+    ignores_tiering = True
+
+    def __init__(self, manager):
+        self.key = manager._object_key
+        self.reset()
+
+    def add(self, obj):
+        key = self.key(obj)
+        self.changed[key] = obj
+        self.removed.discard(key)
+
+    def remove(self, obj):
+        key = self.key(obj)
+        self.changed.pop(key, None)
+        self.removed.add(key)
+
+    def flush(self):
+        pass
+
+    def reset(self):
+        self.full = True  # the whole state has to be written again
+        self.changed = {}  # key -> object
+        self.removed = set()
+
+    def take(self):
+        """
+        Returns whether the whole state has to be written, and the objects
+        changed and the keys removed, and forgets about them.
+        """
+        result = self.full, list(self.changed.values()), list(self.removed)
+        self.full = False
+        self.changed = {}
+        self.removed = set()
+        return result
+
+
+class Cache(object):
+    """
+    Base class of the cache backends, which keep the state of an account in
+    files named after its token in the cache directory.  The token may be
+    set after the backend is created (e.g. by TodoistAPI.deserialize()), in
+    which case the whole state is written to the files of the new token.
+    """
+    def __init__(self, api, directory):
+        self.api = weakref.proxy(api)
+        self.directory = directory
+        self._path = self.path  # path of the files the cache was read from
+        self._trackers = {}
+        for datatype, _ in api._state_models:
+            manager = getattr(api, datatype)
+            self._trackers[datatype] = ChangeTracker(manager)
+            manager._watch(self._trackers[datatype])
+
+    @property
+    def path(self):
+        """
+        Path of the files of the current token, without their extension.
+        """
+        return self.directory + self.api.token
+
+    def load(self):
+        """
+        Loads the state from the cache into the api, and returns whether
+        there was a state to load.
+        """
+        raise NotImplementedError
+
+    def save(self, changes=None):
+        """
+        Writes the state to the cache.  If the ChangeSet of the sync which
+        last updated the state is given, only what changed since the cache
+        was last written may be written.
+        """
+        self.write(self.snapshot(changes))
+
+    def snapshot(self, changes=None):
+        """
+        Returns a Snapshot of what save() has to write, which no longer
+        depends on the state.
+        """
+        raise NotImplementedError
+
+    def write(self, snapshot):
+        """
+        Writes a snapshot to the cache.  It may run in the thread of a
+        CacheWriter after the api is gone, so it only uses the snapshot and
+        what the backend kept when it was created.
+        """
+        raise NotImplementedError
+
+    def has_changes(self):
+        """
+        Returns whether anything changed in the objects since the cache was
+        last written, including changes made outside of syncs, such as the
+        temporary ids of the objects replaced by their real ids.
+        """
+        return any(tracker.full or tracker.changed or tracker.removed
+                   for tracker in self._trackers.values())
+
+    def _take_changes(self):
+        """
+        Returns whether the whole state has to be written, and the objects
+        changed and the keys removed since the cache was last written, by
+        datatype.
+        """
+        full = False
+        if self.path != self._path:
+            full = True
+            self._path = self.path
+        changed, removed = {}, {}
+        for datatype, tracker in self._trackers.items():
+            datatype_full, objs, keys = tracker.take()
+            full = full or datatype_full
+            if objs:
+                changed[datatype] = objs
+            if keys:
+                removed[datatype] = keys
+        return full, changed, removed
+
+    def _loaded(self):
+        """
+        Forgets the changes made by loading the state.
+        """
+        self._take_changes()
+
+    def _invalidate(self):
+        """
+        Makes the next snapshot a full one, after a snapshot could not be
+        written.
+        """
+        for tracker in self._trackers.values():
+            tracker.full = True
+
+    def _state_copy(self):
+        """
+        Returns a copy of the whole state along with the sync token, with the
+        data of the objects in place of the objects.
+        """
+        api = self.api
+        state = {'sync_token': api.sync_token}
+        for name, value in api.state.items():
+            if name in api._state_datatypes:
+                state[name] = [dict(obj.data) for obj in
+                               itertools.chain(value, getattr(api, name)._cold_objects())]
+            else:
+                state[name] = _copy(value)
+        return state
+
+    def merge(self, older, newer):
+        """
+        Returns a partial snapshot with the changes of two partial snapshots
+        taken one after the other, so that they are written at once.
+        """
+        return Snapshot(False, _merge_deltas(older.data, newer.data), newer.path)
+
+    def _delta(self, changes, changed, removed):
+        """
+        Returns the changes of a sync, which update the state as it was when
+        the cache was last written to the current state, as a (state, objs)
+        pair: the sync token and the rest of the state which changed, and
+        the data of the objects which changed (or the fields identifying the
+        ones removed, with is_deleted set) by datatype and key.  See
+        _sync_data().
+        """
+        state = {'sync_token': self.api.sync_token}
+        for datatype in changes.datatypes():
+            if datatype not in self.api._state_datatypes:
+                state[datatype] = _copy(self.api.state[datatype])
+        objs = {}
+        for datatype, changed_objs in changed.items():
+            key = getattr(self.api, datatype)._object_key
+            objs[datatype] = dict((key(obj), dict(obj.data)) for obj in changed_objs)
+        for datatype, keys in removed.items():
+            key_data = getattr(self.api, datatype)._key_data
+            objs.setdefault(datatype, {}).update((key, dict(key_data(key), is_deleted=1))
+                                                 for key in keys)
+        return state, objs
+
+
+def _merge_deltas(older, newer):
+    state = dict(older[0])
+    state.update(newer[0])
+    objs = dict((datatype, dict(datatype_objs)) for datatype, datatype_objs in older[1].items())
+    for datatype, datatype_objs in newer[1].items():
+        objs.setdefault(datatype, {}).update(datatype_objs)
+    return state, objs
+
+
+def _sync_data(delta):
+    """
+    Returns the changes returned by Cache._delta() as sync data, which
+    TodoistAPI._update_state() merges into the state.
+    """
+    state, objs = delta
+    data = dict(state)
+    for datatype, datatype_objs in objs.items():
+        data[datatype] = list(datatype_objs.values())
+    return data
+
+
+class JSONCache(Cache):
+    """
+    Keeps the state in ``<token>.json`` and the sync token in ``<token>.sync``,
+    written in full from time to time, and appends the changes of the syncs
+    made since to ``<token>.journal``, one line of JSON for each sync.
+
+    The cache is written in full again once the journal is larger than both
+    journal_min_bytes and journal_ratio times the cache itself, or once it is
+    loaded with a journal ending with an incomplete entry, unless read_only
+    is set.
+    """
+    journal_min_bytes = 1 << 20
+    journal_ratio = 0.5
+
+    def __init__(self, api, directory, read_only=False):
+        super(JSONCache, self).__init__(api, directory)
+        self.read_only = read_only
+
+    def load(self):
+        with open(self.path + '.json') as f:
+            state = f.read()
+        self.api._update_state(json_loads(state))
+
+        with open(self.path + '.sync') as f:
+            sync_token = f.read()
+        self.api.sync_token = sync_token
+
+        if self._replay_journal() or self.read_only:
+            self._loaded()
+        else:
+            self.save()
+        return True
+
+    def _replay_journal(self):
+        """
+        Applies the changes appended to the journal since the cache was last
+        written in full.  False is returned if the journal ends with an
+        incomplete entry, which is then ignored along with anything after it.
+        """
+        try:
+            journal = open(self.path + '.journal')
+        except (IOError, OSError):
+            return True
+        with journal:
+            for line in journal:
+                try:
+                    delta = json_loads(line)
+                except ValueError:
+                    return False
+                self.api._update_state(delta)
+        return True
+
+    def snapshot(self, changes=None):
+        full, changed, removed = self._take_changes()
+        if changes is None or full or not self.api.journal or self._journal_full():
+            return Snapshot(True, self._state_copy(), self._path)
+        return Snapshot(False, self._delta(changes, changed, removed), self._path)
+
+    def write(self, snapshot):
+        path = snapshot.path
+        if not snapshot.full:
+            with open(path + '.journal', 'a') as f:
+                f.write(state_dumps(_sync_data(snapshot.data)) + '\n')
+            return
+
+        # The journal is emptied first: if writing the cache is interrupted,
+        # the cache is left as it was, rather than with a journal which does
+        # not match it.
+        with open(path + '.journal', 'w'):
+            pass
+        state = dict(snapshot.data)
+        sync_token = state.pop('sync_token')
+        atomic_write(path + '.json', json.dumps(state, indent=2, sort_keys=True))
+        atomic_write(path + '.sync', sync_token)
+
+    def _journal_full(self):
+        try:
+            journal_size = os.path.getsize(self.path + '.journal')
+            cache_size = os.path.getsize(self.path + '.json')
+        except OSError:
+            return True
+        return journal_size > max(self.journal_min_bytes, self.journal_ratio * cache_size)
+
+
+class SQLiteCache(Cache):
+    """
+    Keeps the state in the ``<token>.sqlite`` SQLite database, with a table
+    for each datatype of objects, holding a row for each object, and a
+    ``state`` table for the sync token and the rest of the state.  Each save
+    upserts and deletes the rows of the objects which changed, in a single
+    transaction.
+
+    Besides the JSON data of each object, its ``id``, ``project_id`` and
+    ``item_id`` are kept in indexed columns, for the queries run with
+    execute().
+    """
+    columns = ('id', 'project_id', 'item_id')
+
+    def __init__(self, api, directory):
+        super(SQLiteCache, self).__init__(api, directory)
+        # The snapshots may be written by the thread of a CacheWriter, after
+        # the api is gone, so write() does not refer to it.
+        self.db = None
+        self._db_path = None
+        self._lock = threading.Lock()
+        self.datatypes = sorted(api._state_datatypes)
+
+    def _connect(self, path):
+        """
+        Returns the connection to the database of the files at path, opening
+        it in place of the previous one if the token changed.
+        """
+        if path == self._db_path:
+            return self.db
+        if self.db is not None:
+            self.db.close()
+        self.db = sqlite3.connect(path + '.sqlite', check_same_thread=False)
+        self._db_path = path
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS state '
+                            '(name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            for datatype in self.datatypes:
+                self.db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+                                'id, project_id, item_id, data TEXT NOT NULL)' % datatype)
+                for column in self.columns:
+                    self.db.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' %
+                                    (datatype, column, datatype, column))
+        return self.db
+
+    def execute(self, sql, parameters=()):
+        """
+        Runs an SQL query on the cache, and returns the resulting rows, e.g.
+        ``execute('SELECT project_id, COUNT(*) FROM items GROUP BY 1')``.
+        """
+        with self._lock:
+            return self._connect(self._path).execute(sql, parameters).fetchall()
+
+    def load(self):
+        with self._lock:
+            db = self._connect(self.path)
+            rows = dict(db.execute('SELECT name, value FROM state'))
+            if 'sync_token' not in rows:
+                return False
+            state = dict((name, json_loads(value)) for name, value in rows.items()
+                         if name != 'sync_token')
+            for datatype in self.datatypes:
+                state[datatype] = [json_loads(data) for data, in
+                                   db.execute('SELECT data FROM %s' % datatype)]
+        self.api._update_state(state)
+        self.api.sync_token = json_loads(rows['sync_token'])
+        self._loaded()
+        return True
+
+    def snapshot(self, changes=None):
+        full, changed, removed = self._take_changes()
+        api = self.api
+        full = changes is None or full
+        if full:
+            changed = dict((datatype, itertools.chain(api.state[datatype],
+                                                      getattr(api, datatype)._cold_objects()))
+                           for datatype in api._state_datatypes)
+            removed = {}
+            others = [name for name in api.state if name not in api._state_datatypes]
+        else:
+            others = [name for name in changes.datatypes()
+                      if name not in api._state_datatypes]
+        rows = {}
+        for datatype, objs in changed.items():
+            key = getattr(api, datatype)._object_key
+            rows[datatype] = [(key(obj), dict(obj.data)) for obj in objs]
+        state = dict((name, _copy(api.state[name])) for name in others)
+        state['sync_token'] = api.sync_token
+        return Snapshot(full, (rows, removed, state), self._path)
+
+    def merge(self, older, newer):
+        rows = dict((datatype, dict(datatype_rows))
+                    for datatype, datatype_rows in older.data[0].items())
+        removed = dict((datatype, set(keys)) for datatype, keys in older.data[1].items())
+        state = dict(older.data[2])
+        newer_rows, newer_removed, newer_state = newer.data
+        for datatype, datatype_rows in newer_rows.items():
+            rows.setdefault(datatype, {}).update(datatype_rows)
+            removed.get(datatype, set()).difference_update(key for key, _ in datatype_rows)
+        for datatype, keys in newer_removed.items():
+            for key in keys:
+                rows.get(datatype, {}).pop(key, None)
+            removed.setdefault(datatype, set()).update(keys)
+        state.update(newer_state)
+        rows = dict((datatype, list(datatype_rows.items()))
+                    for datatype, datatype_rows in rows.items())
+        removed = dict((datatype, list(keys)) for datatype, keys in removed.items())
+        return Snapshot(False, (rows, removed, state), newer.path)
+
+    def write(self, snapshot):
+        rows, removed, state = snapshot.data
+        with self._lock:
+            db = self._connect(snapshot.path)
+            with db:
+                if snapshot.full:
+                    for datatype in self.datatypes:
+                        db.execute('DELETE FROM %s' % datatype)
+                for datatype, datatype_rows in rows.items():
+                    db.executemany(
+                        'INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)' % datatype,
+                        [(key,) + tuple(_column(data.get(column)) for column in self.columns) +
+                         (state_dumps(data),) for key, data in datatype_rows])
+                for datatype, keys in removed.items():
+                    db.executemany('DELETE FROM %s WHERE key = ?' % datatype,
+                                   [(key,) for key in keys])
+                db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                               [(name, state_dumps(value)) for name, value in state.items()])
+
+
+def _pickle_dumps(obj):
+    return pickle.dumps(obj, protocol=min(5, pickle.HIGHEST_PROTOCOL))
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, object_pairs_hook=interned_object)
+
+
+#: codecs of the binary cache: name -> (number in the header, dumps, loads)
+CODECS = {
+    'pickle': (1, _pickle_dumps, pickle.loads),
+    'marshal': (2, marshal.dumps, marshal.loads),
+}
+if msgpack is not None:
+    CODECS['msgpack'] = (3, _msgpack_dumps, _msgpack_loads)
+
+
+class BinaryCache(Cache):
+    """
+    Keeps the state in ``<token>.bin``, in a binary format: a header made of
+    a magic string, the version of the format, the codec and whether records
+    are compressed with zlib, followed by length-prefixed records.  The first
+    record holds the whole state along with the sync token, and each of the
+    next ones the changes of a sync, as in the journal of JSONCache.  The
+    file is written in full again once the records appended are larger than
+    both journal_min_bytes and journal_ratio times the first one.
+
+    The codec is msgpack when it is installed, and pickle otherwise, unless
+    one of CODECS is given.  Files written with any codec or version of the
+    format are read, as long as the codec is available and the version is
+    not newer than this one; records appended to them use their codec until
+    they are written in full again.
+    """
+    magic = b'TDSC'
+    version = 1
+    header = struct.Struct('>4sHBB')
+    length = struct.Struct('>I')
+    journal_min_bytes = 1 << 20
+    journal_ratio = 0.5
+
+    def __init__(self, api, directory, codec=None, compress=False):
+        super(BinaryCache, self).__init__(api, directory)
+        if codec is None:
+            codec = 'msgpack' if 'msgpack' in CODECS else 'pickle'
+        self.codec = codec
+        self.compress = compress
+        # Codec and compression of the file on disk, which records appended
+        # to it must use, until it is written in full with the ones above
+        self._file_codec = codec
+        self._file_compress = compress
+        self._first_size = self._appended = 0
+
+    @property
+    def filename(self):
+        return self.path + '.bin'
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            content = f.read()
+        magic, version, codec_number, compress = self.header.unpack_from(content)
+        if magic != self.magic or version > self.version:
+            return False
+        codecs = dict((number, name) for name, (number, _, _) in CODECS.items())
+        loads = CODECS[codecs[codec_number]][2]
+
+        offset = self.header.size
+        complete = True
+        records = 0
+        while offset < len(content):
+            start = offset + self.length.size
+            if start > len(content):
+                complete = False
+                break
+            size, = self.length.unpack_from(content, offset)
+            record = content[start:start + size]
+            if len(record) < size:
+                complete = False
+                break
+            if compress:
+                record = zlib.decompress(record)
+            self.api._update_state(loads(record))
+            if records == 0:
+                self._first_size = size
+            else:
+                self._appended += self.length.size + size
+            records += 1
+            offset = start + size
+        if records == 0:
+            return False
+        self._file_codec = codecs[codec_number]
+        self._file_compress = bool(compress)
+        if complete:
+            self._loaded()
+        else:
+            self.save()
+        return True
+
+    def snapshot(self, changes=None):
+        full, changed, removed = self._take_changes()
+        if (changes is None or full or not self.api.journal or
+                self._appended > max(self.journal_min_bytes,
+                                     self.journal_ratio * self._first_size)):
+            return Snapshot(True, self._state_copy(), self._path)
+        return Snapshot(False, self._delta(changes, changed, removed), self._path)
+
+    def write(self, snapshot):
+        filename = snapshot.path + '.bin'
+        if not snapshot.full:
+            record = self._record(_sync_data(snapshot.data), self._file_codec,
+                                  self._file_compress)
+            with open(filename, 'ab') as f:
+                f.write(record)
+            self._appended += len(record)
+            return
+        header = self.header.pack(self.magic, self.version,
+                                  CODECS[self.codec][0], bool(self.compress))
+        record = self._record(snapshot.data, self.codec, self.compress)
+        atomic_write(filename, header + record, 'wb')
+        self._file_codec = self.codec
+        self._file_compress = self.compress
+        self._first_size = len(record) - self.length.size
+        self._appended = 0
+
+    def _record(self, data, codec, compress):
+        record = CODECS[codec][1](data)
+        if compress:
+            record = zlib.compress(record)
+        return self.length.pack(len(record)) + record
+
+
+def convert_json_cache(token, cache='~/.todoist-sync/', **options):
+    """
+    Converts the JSON cache of an account, ``<token>.json`` and
+    ``<token>.sync`` (along with the journal), to the binary format, with
+    the options of BinaryCache, and returns the path of the binary file.
+    The JSON files are left as they are.
+    """
+    from .api import TodoistAPI
+    api = TodoistAPI(token, cache=cache,
+                     cache_backend=functools.partial(JSONCache, read_only=True))
+    if api.sync_token == '*':
+        raise ValueError('no JSON cache of this token in %s' % cache)
+    binary = BinaryCache(api, api.cache, **options)
+    binary.save()
+    return binary.filename
+
+
+class ShardedCache(Cache):
+    """
+    Keeps each datatype of objects in its own file,
+    ``<token>.shard.<datatype>.json``, and the rest of the state along with
+    the sync token in ``<token>.shard.state.json``, which is written last.
+    Only the files of the datatypes which changed are written again.
+
+    Loading only reads the latter file: each datatype of objects is loaded
+    when first used, through its manager or through the state (see
+    LazyState).  With preload, all of them are read and decoded at once
+    instead, by a pool of threads.
+    """
+    def __init__(self, api, directory, preload=False, workers=4):
+        super(ShardedCache, self).__init__(api, directory)
+        self.preload = preload
+        self.workers = workers
+
+    def _shard_path(self, path, name):
+        return '%s.shard.%s.json' % (path, name)
+
+    def load(self):
+        try:
+            with open(self._shard_path(self.path, 'state')) as f:
+                state = json_loads(f.read())
+        except (IOError, OSError):
+            return False
+        sync_token = state.pop('sync_token')
+        self.api._update_state(state)
+        self.api.sync_token = sync_token
+
+        lazy_state = LazyState(self.api, self.api.state, self._load_shard)
+        self.api.state = lazy_state
+        for datatype in sorted(self.api._state_datatypes):
+            if os.path.exists(self._shard_path(self.path, datatype)):
+                lazy_state.defer(datatype)
+        if self.preload:
+            datatypes = sorted(lazy_state.pending)
+            if ThreadPoolExecutor is not None and self.workers > 1:
+                with ThreadPoolExecutor(self.workers) as executor:
+                    shards = list(executor.map(self._read_shard, datatypes))
+            else:
+                shards = [self._read_shard(datatype) for datatype in datatypes]
+            for datatype, data in zip(datatypes, shards):
+                lazy_state.load(datatype, data)
+        self._loaded()
+        return True
+
+    def _read_shard(self, datatype):
+        with open(self._shard_path(self._path, datatype)) as f:
+            return json_loads(f.read())
+
+    def _load_shard(self, datatype, data=None):
+        """
+        Merges the objects of a datatype read from the cache into the state,
+        without reporting them as changes.
+        """
+        if data is None:
+            data = self._read_shard(datatype)
+        model = self.api._datatype_models[datatype]
+        self.api._merge_objects(datatype, model, data, ChangeSet())
+        self._trackers[datatype].take()
+        indexes = getattr(self.api, datatype)._indexes
+        if 'text' in indexes:
+            indexes['text'].clear_preloaded()
+
+    def snapshot(self, changes=None):
+        api = self.api
+        if self.path != self._path and isinstance(api.state, LazyState):
+            # The shards not loaded yet are only in the files of the previous
+            # token.
+            api.state.load_all()
+        full, changed, removed = self._take_changes()
+        full = changes is None or full
+        if full:
+            datatypes = api._state_datatypes
+        else:
+            datatypes = set(changed) | set(removed)
+        pending = api.state.pending if isinstance(api.state, LazyState) else ()
+        shards = dict((datatype, [dict(obj.data) for obj in
+                                  itertools.chain(api.state[datatype],
+                                                  getattr(api, datatype)._cold_objects())])
+                      for datatype in datatypes if datatype not in pending)
+        state = dict((name, _copy(value)) for name, value in dict.items(api.state)
+                     if name not in api._state_datatypes)
+        state['sync_token'] = api.sync_token
+        return Snapshot(full, (shards, state), self._path)
+
+    def merge(self, older, newer):
+        # The shards hold all the objects of their datatype, and the state
+        # all the rest of the state.
+        shards = dict(older.data[0])
+        shards.update(newer.data[0])
+        return Snapshot(False, (shards, newer.data[1]), newer.path)
+
+    def write(self, snapshot):
+        shards, state = snapshot.data
+        for datatype, data in shards.items():
+            atomic_write(self._shard_path(snapshot.path, datatype), state_dumps(data))
+        atomic_write(self._shard_path(snapshot.path, 'state'), state_dumps(state))
+
+
+class LazyState(dict):
+    """
+    Local state whose lists of objects of some datatypes are only loaded from
+    the cache when first used, either through the state, or through their
+    manager, which is set aside until then.
+    """
+    def __init__(self, api, state, loader):
+        dict.__init__(self, state)
+        self._api = api
+        self._loader = loader
+        self._managers = {}  # datatype -> manager set aside
+
+    @property
+    def pending(self):
+        """
+        The datatypes which are yet to be loaded.
+        """
+        return frozenset(self._managers)
+
+    def defer(self, datatype):
+        self._managers[datatype] = self._api.__dict__.pop(datatype)
+
+    def load(self, datatype, *args):
+        manager = self._managers.pop(datatype, None)
+        if manager is not None:
+            self._api.__dict__[datatype] = manager
+            self._loader(datatype, *args)
+
+    def load_all(self):
+        for datatype in list(self._managers):
+            self.load(datatype)
+
+    def discard(self):
+        """
+        Puts the managers back without loading their objects.
+        """
+        for datatype, manager in self._managers.items():
+            self._api.__dict__[datatype] = manager
+        self._managers = {}
+
+    def __getitem__(self, key):
+        self.load(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self.load(key)
+        return dict.get(self, key, default)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+
+class CacheWriter(object):
+    """
+    Writes the snapshots of a cache backend in a background thread.  The
+    snapshots are only written once none was taken for delay seconds, or
+    once the first one waited for max_delay seconds, so that a burst of syncs
+    leads to a single write: a full snapshot replaces the ones still to be
+    written, and the partial ones are merged into the partial one before
+    them (see Cache.merge()).
+
+    If writing fails, the snapshots still to be written are dropped, the
+    next snapshot is a full one, and the error is raised by flush().
+    """
+    def __init__(self, backend, delay=1.0, max_delay=None):
+        self.backend = backend
+        self.delay = delay
+        self.max_delay = 10 * delay if max_delay is None else max_delay
+        self.error = None
+        self._condition = threading.Condition()
+        self._snapshots = []
+        self._first = self._last = None  # times the snapshots were taken
+        self._thread = None
+        self._writing = False
+        self._flushing = False
+        _writers.add(self)
+
+    def put(self, changes=None):
+        """
+        Takes a snapshot of the changes of the state (see Cache.save()), to
+        be written in the background.
+        """
+        with self._condition:
+            snapshot = self.backend.snapshot(changes)
+            last = self._snapshots[-1] if self._snapshots else None
+            if snapshot.full:
+                self._snapshots = [snapshot]
+            elif last is not None and not last.full and last.path == snapshot.path:
+                self._snapshots[-1] = self.backend.merge(last, snapshot)
+            else:
+                self._snapshots.append(snapshot)
+            self._last = time.time()
+            if self._first is None:
+                self._first = self._last
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Writes the snapshots still to be written right away, and waits until
+        they are written.
+        """
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            while self._snapshots or self._writing:
+                self._condition.wait()
+            self._flushing = False
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._snapshots and not self._flushing:
+                    now = time.time()
+                    remaining = min(self._last + self.delay, self._first + self.max_delay) - now
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                snapshots, self._snapshots = self._snapshots, []
+                self._first = None
+                if not snapshots:
+                    self._thread = None
+                    self._condition.notify_all()
+                    return
+                self._writing = True
+            try:
+                for snapshot in snapshots:
+                    self.backend.write(snapshot)
+            except Exception as error:
+                with self._condition:
+                    self.error = error
+                    self._snapshots = []
+                    self.backend._invalidate()
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+
+_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_writers():
+    for writer in list(_writers):
+        try:
+            writer.flush()
+        except Exception:
+            traceback.print_exc()
+
+
+def _column(value):
+    """
+    Returns the value of a field as stored in an indexed column.
+    """
+    return None if isinstance(value, (list, dict)) else value
+
+
+#: cache backends, by name
+BACKENDS = {
+    'json': JSONCache,
+    'sqlite': SQLiteCache,
+    'sharded': ShardedCache,
+    'binary': BinaryCache,
+}
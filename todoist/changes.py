@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Structured description of the changes that a sync made to the local state.
+"""
+import collections
+
+#: A single change: kind is one of 'added', 'updated' or 'deleted', obj is
+#: the object that changed (for the datatypes which are not lists of objects,
+#: such as 'user', the whole value in the state), and fields holds the names
+#: of the fields that changed for updates, or None otherwise.
+Change = collections.namedtuple('Change', 'datatype kind obj fields')
+
+_missing = object()
+
+
+def changed_fields(old, new):
+    """
+    Returns the names of the fields of new whose value differs from old.
+    """
+    return [key for key, value in new.items() if old.get(key, _missing) != value]
+
+
+class ChangeSet(object):
+    """
+    Objects added, updated and deleted by a sync, by datatype.  Iterating
+    over it yields a Change for each one of them.
+    """
+    def __init__(self):
+        self._changes = collections.OrderedDict()
+
+    def _datatype(self, datatype):
+        changes = self._changes.get(datatype)
+        if changes is None:
+            changes = self._changes[datatype] = {'added': [], 'updated': [],
+                                                 'deleted': []}
+        return changes
+
+    def add(self, datatype, kind, obj, fields=None):
+        self._datatype(datatype)[kind].append(Change(datatype, kind, obj, fields))
+
+    def added(self, datatype):
+        """
+        Returns the objects of a datatype added by the sync.
+        """
+        return [change.obj for change in self._changes.get(datatype, {}).get('added', ())]
+
+    def updated(self, datatype):
+        """
+        Returns (object, changed fields) pairs for the objects of a datatype
+        updated by the sync.
+        """
+        return [(change.obj, change.fields) for change in
+                self._changes.get(datatype, {}).get('updated', ())]
+
+    def deleted(self, datatype):
+        """
+        Returns the objects of a datatype deleted by the sync.
+        """
+        return [change.obj for change in self._changes.get(datatype, {}).get('deleted', ())]
+
+    def datatypes(self):
+        """
+        Returns the datatypes which had any change.
+        """
+        return list(self._changes)
+
+    def __iter__(self):
+        for changes in self._changes.values():
+            for kind in ('added', 'updated', 'deleted'):
+                for change in changes[kind]:
+                    yield change
+
+    def __len__(self):
+        return sum(len(changes[kind]) for changes in self._changes.values()
+                   for kind in ('added', 'updated', 'deleted'))
+
+    def __bool__(self):
+        return bool(self._changes)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        counts = ', '.join('%s: +%d ~%d -%d' % (datatype, len(c['added']),
+                                                len(c['updated']), len(c['deleted']))
+                           for datatype, c in self._changes.items())
+        return 'ChangeSet(%s)' % counts
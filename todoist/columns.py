@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar copy of the local items, for analytics over large accounts.
+
+Each field is kept in an ``array.array`` with one row per item: integer
+fields as 64-bit integers (C longs on Python 2), the due date as a float
+timestamp, and string fields as integer codes into a dictionary of their
+distinct values.  Filters and group-bys run over the columns, vectorized with
+NumPy when it is installed, and with plain loops over the arrays otherwise.
+"""
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    array.array('q')
+    INT_TYPECODE = 'q'
+except ValueError:  # Python 2 has no 64-bit typecode
+    INT_TYPECODE = 'l'
+
+try:
+    integer_types = (int, long)  # noqa
+    string_types = basestring  # noqa
+except NameError:
+    integer_types = (int,)
+    string_types = str
+
+#: stands for the values of integer fields which are missing or not integers
+MISSING = -2 ** (8 * array.array(INT_TYPECODE).itemsize - 1)
+NAN = float('nan')
+
+
+class ColumnStore(object):
+    """
+    Keeps the fields of a set of items in columns, and is kept up to date
+    by the items manager as a watcher of the local state.
+
+    Rows are kept dense: removing an item moves the last row in its place,
+    so the order of the rows is not meaningful.
+    """
+    int_fields = ('id', 'project_id', 'priority', 'checked', 'in_history',
+                  'is_deleted', 'indent', 'item_order', 'day_order',
+                  'user_id', 'responsible_uid')
+    float_fields = ('due',)
+    str_fields = ('date_string', 'date_lang')
+    #: values of the integer fields assumed for the items without them, as
+    #: with ItemsManager.field_defaults
+    int_defaults = {'checked': 0, 'in_history': 0}
+
+    def __init__(self, use_numpy=None):
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.reset()
+
+    def reset(self):
+        self._objects = []  # row -> item
+        self._rows = {}  # item -> row
+        self._columns = {}
+        for field in self.int_fields:
+            self._columns[field] = array.array(INT_TYPECODE)
+        for field in self.float_fields:
+            self._columns[field] = array.array('d')
+        for field in self.str_fields:
+            self._columns[field] = array.array(INT_TYPECODE)
+        self._codes = dict((field, {}) for field in self.str_fields)
+        self._values = dict((field, []) for field in self.str_fields)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, item):
+        return item in self._rows
+
+    # watcher interface
+    def add(self, item):
+        if item in self._rows:
+            return
+        self._rows[item] = len(self._objects)
+        self._objects.append(item)
+        data = item.data
+        for field in self.int_fields:
+            value = data.get(field)
+            if value is None:
+                value = self.int_defaults.get(field)
+            self._columns[field].append(self._int(value))
+        due = item.due_timestamp
+        self._columns['due'].append(NAN if due is None else due)
+        for field in self.str_fields:
+            self._columns[field].append(self._code(field, data.get(field)))
+
+    def remove(self, item):
+        row = self._rows.pop(item, None)
+        if row is None:
+            return
+        last = self._objects.pop()
+        if last is not item:
+            self._objects[row] = last
+            self._rows[last] = row
+        for column in self._columns.values():
+            value = column.pop()
+            if last is not item:
+                column[row] = value
+
+    def flush(self):
+        pass
+
+    def _int(self, value):
+        """
+        Returns the value of an integer field as stored in its column.  As
+        with index_key(), ``'123'`` is stored as ``123``.
+        """
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, string_types):
+            try:
+                value = int(value)
+            except ValueError:
+                return MISSING
+        if isinstance(value, integer_types) and MISSING < value < -MISSING:
+            return value
+        return MISSING
+
+    def _code(self, field, value):
+        codes = self._codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self._values[field])
+            self._values[field].append(value)
+        return code
+
+    def _decode(self, field, value):
+        if field in self._values:
+            return self._values[field][value]
+        if field in self.float_fields:
+            return None if value != value else value
+        return None if value == MISSING else value
+
+    # queries
+    def column(self, field):
+        """
+        Returns a copy of a column, as a NumPy array if NumPy is used, and as
+        an ``array.array`` otherwise.  String fields are returned as codes,
+        which values() maps back to strings.
+        """
+        if self.use_numpy:
+            return numpy.array(self._columns[field])
+        return array.array(self._columns[field].typecode, self._columns[field])
+
+    def values(self, field):
+        """
+        Returns the distinct values of a string field, indexed by their code.
+        """
+        return list(self._values[field])
+
+    def select(self, **conditions):
+        """
+        Returns the items whose fields match all the conditions.  A condition
+        is either a value, a list or set of values any of which may match, or
+        a ``(start, end)`` tuple matching values in the half-open range, where
+        either end may be None, e.g. ``select(priority=[3, 4], checked=0,
+        due=(start, end))``.
+        """
+        return [self._objects[row] for row in self._match(conditions)]
+
+    def count(self, **conditions):
+        """
+        Returns the number of items matching the conditions, as in select().
+        """
+        return len(self._match(conditions))
+
+    def count_by(self, *fields, **conditions):
+        """
+        Returns the number of items matching the conditions for each
+        combination of values of the fields, e.g. ``count_by('project_id',
+        'priority', checked=0)`` maps ``(project_id, priority)`` pairs to
+        counts.  When a single field is given, its values are the keys.
+        """
+        rows = self._match(conditions)
+        if self.use_numpy and len(rows):
+            # Numbers the distinct values of each field, and counts the
+            # combinations of these numbers.
+            uniques, inverses = [], []
+            for field in fields:
+                unique, inverse = numpy.unique(self._array(field)[rows],
+                                               return_inverse=True)
+                uniques.append(unique.tolist())
+                inverses.append(inverse.ravel())
+            shape = tuple(len(unique) for unique in uniques)
+            counts = numpy.bincount(numpy.ravel_multi_index(inverses, shape))
+            groups = []
+            for combination in numpy.flatnonzero(counts):
+                indices = numpy.unravel_index(combination, shape)
+                groups.append((tuple(unique[i] for unique, i in zip(uniques, indices)),
+                               int(counts[combination])))
+        else:
+            counts = {}
+            keys = zip(*[[column[row] for row in rows]
+                         for column in (self._columns[field] for field in fields)])
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+            groups = counts.items()
+        result = {}
+        for key, count in groups:
+            key = tuple(self._decode(field, value)
+                        for field, value in zip(fields, key))
+            key = key[0] if len(fields) == 1 else key
+            result[key] = result.get(key, 0) + count
+        return result
+
+    def _array(self, field):
+        """
+        Returns a NumPy array sharing the memory of a column, which is only
+        to be used while the column is not changed.
+        """
+        column = self._columns[field]
+        dtype = (numpy.float64 if column.typecode == 'd'
+                 else numpy.dtype('i%d' % column.itemsize))
+        if not column:
+            return numpy.array([], dtype)
+        return numpy.frombuffer(column, dtype)
+
+    def _encode(self, field, value):
+        """
+        Returns the value of a condition as stored in the column of a field,
+        or None if no row can have it.
+        """
+        if field in self._codes:
+            return self._codes[field].get(value)
+        if field in self.float_fields:
+            return NAN if value is None else float(value)
+        if value is None:
+            return MISSING
+        value = self._int(value)
+        return None if value == MISSING else value
+
+    def _bounds(self, field, value):
+        start, end = value
+        if start is None and field in self.int_fields:
+            start = MISSING + 1  # missing values are not in any range
+        return start, end
+
+    def _match(self, conditions):
+        """
+        Returns the rows matching the conditions, as a NumPy array of row
+        numbers if NumPy is used, and as a list otherwise.
+        """
+        if self.use_numpy:
+            return self._match_numpy(conditions)
+        rows = range(len(self._objects))
+        for field, value in conditions.items():
+            column = self._columns[field]
+            if isinstance(value, tuple):
+                start, end = self._bounds(field, value)
+                if start is not None:
+                    rows = [row for row in rows if column[row] >= start]
+                if end is not None:
+                    rows = [row for row in rows if column[row] < end]
+            else:
+                values = value if isinstance(value, (list, set, frozenset)) else [value]
+                codes = set(self._encode(field, v) for v in values)
+                rows = [row for row in rows if column[row] in codes]
+        return list(rows)
+
+    def _match_numpy(self, conditions):
+        mask = numpy.ones(len(self._objects), dtype=bool)
+        for field, value in conditions.items():
+            column = self._array(field)
+            if isinstance(value, tuple):
+                start, end = self._bounds(field, value)
+                if start is not None:
+                    mask &= column >= start
+                if end is not None:
+                    mask &= column < end
+            else:
+                values = value if isinstance(value, (list, set, frozenset)) else [value]
+                codes = [self._encode(field, v) for v in values]
+                mask &= numpy.isin(column, [c for c in codes if c is not None])
+        return numpy.flatnonzero(mask)
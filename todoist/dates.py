@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to deal with the dates returned by the server, which come in the
+``Fri 26 Sep 2014 08:25:05 +0000`` format.
+"""
+import calendar
+import datetime
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+DAY = 24 * 3600
+
+
+class _UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+UTC = _UTC()
+
+
+def parse_offset(value):
+    """
+    Converts an offset such as ``+0530`` or ``-03:00`` to seconds.
+    """
+    sign = -1 if value[0] == '-' else 1
+    value = value.lstrip('+-').replace(':', '')
+    return sign * (int(value[:2]) * 3600 + int(value[2:4] or 0) * 60)
+
+
+def parse_timestamp(value):
+    """
+    Converts a date returned by the server, or a ``YYYY-MM-DDTHH:MM[:SS]``
+    UTC date as accepted by it, to seconds since the epoch.  None is returned
+    if the date is empty or cannot be parsed.
+    """
+    if not value:
+        return None
+    try:
+        if value[:4].isdigit():
+            date, time = value.split('T', 1)
+            year, month, day = date.split('-')
+            offset = 0
+        else:
+            _, day, month, year, time, offset = value.split()
+            month = MONTHS[month]
+            offset = parse_offset(offset)
+        hms = [int(v) for v in time.rstrip('Z').split(':')] + [0, 0]
+        return calendar.timegm((int(year), int(month), int(day),
+                                hms[0], hms[1], hms[2], 0, 0, 0)) - offset
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def to_datetime(timestamp):
+    """
+    Converts seconds since the epoch to an aware datetime in UTC, passing
+    None through.
+    """
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, UTC)
+
+
+def user_offset(user):
+    """
+    Returns the offset from UTC of the user's timezone in seconds, based on
+    the ``tz_info`` of the user object.
+    """
+    tz_info = user.get('tz_info') or {}
+    if tz_info.get('gmt_string'):
+        try:
+            return parse_offset(tz_info['gmt_string'])
+        except (ValueError, IndexError):
+            pass
+    return tz_info.get('hours', 0) * 3600 + tz_info.get('minutes', 0) * 60
+
+
+def day_start(timestamp, offset=0):
+    """
+    Returns the timestamp of the beginning of the day which the timestamp
+    falls in, in a timezone with the given offset from UTC.
+    """
+    return timestamp - (timestamp + offset) % DAY
@@ -0,0 +1,747 @@
+# -*- coding: utf-8 -*-
+"""
+Secondary indexes over the objects of the local state, kept up to date by the
+managers as objects are added, updated and removed.
+"""
+import re
+import zlib
+import math
+import bisect
+import itertools
+
+from .models import content_hash
+
+try:
+    string_types = basestring  # noqa
+except NameError:
+    string_types = str
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def index_key(value):
+    """
+    Normalizes an id or a field value, so that e.g. ``123`` and ``'123'``, or
+    ``True`` and ``1``, are looked up under the same key.
+    """
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value)
+
+
+class FieldIndex(object):
+    """
+    Maps the values of a field to the objects having them.  When the field
+    holds a list (e.g. the labels of an item), the object is found under each
+    one of its values.  The objects without the field are found under the
+    default value, if one is given.
+    """
+    def __init__(self, field, default=None):
+        self.field = field
+        self.default = default
+        self._objs = {}  # key -> set of objects
+        self._keys = {}  # object -> keys it was indexed under
+
+    def _get_keys(self, obj):
+        value = obj.data.get(self.field)
+        if value is None:
+            value = self.default
+        if value is None:
+            return ()
+        if isinstance(value, (list, tuple)):
+            return tuple(set(index_key(v) for v in value))
+        return (index_key(value),)
+
+    def add(self, obj):
+        keys = self._get_keys(obj)
+        if keys:
+            self._keys[obj] = keys
+            for key in keys:
+                self._objs.setdefault(key, set()).add(obj)
+
+    def remove(self, obj):
+        for key in self._keys.pop(obj, ()):
+            objs = self._objs[key]
+            objs.discard(obj)
+            if not objs:
+                del self._objs[key]
+
+    def get(self, value):
+        """
+        Returns the set of objects having the value.
+        """
+        return self._objs.get(index_key(value), frozenset())
+
+
+class SortedList(object):
+    """
+    List of values kept sorted as values are added and removed, split in
+    sorted chunks of at most 2 * load values each, which are split in two
+    once they grow larger.  Adding or removing a value only shifts the values
+    of one chunk, so that adding n values in any order takes O(n log n)
+    rather than the O(n ** 2) of inserting them in a single list.
+    """
+    load = 500
+
+    def __init__(self):
+        self._chunks = []  # sorted lists of values
+        self._maxes = []  # last value of each chunk
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.irange()
+
+    def add(self, value):
+        self._len += 1
+        if not self._chunks:
+            self._chunks.append([value])
+            self._maxes.append(value)
+            return
+        i = min(bisect.bisect_left(self._maxes, value), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        bisect.insort(chunk, value)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * self.load:
+            self._chunks[i:i + 1] = [chunk[:self.load], chunk[self.load:]]
+            self._maxes[i:i + 1] = [chunk[self.load - 1], chunk[-1]]
+
+    def remove(self, value):
+        """
+        Removes a value, which has to be in the list.
+        """
+        i = bisect.bisect_left(self._maxes, value)
+        chunk = self._chunks[i]
+        del chunk[bisect.bisect_left(chunk, value)]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def before(self, value):
+        """
+        Returns the greatest value which is less than the given one, or None.
+        """
+        i = bisect.bisect_left(self._maxes, value)
+        if i < len(self._chunks):
+            pos = bisect.bisect_left(self._chunks[i], value)
+            if pos:
+                return self._chunks[i][pos - 1]
+        return self._chunks[i - 1][-1] if i else None
+
+    def irange(self, start=None):
+        """
+        Yields the values which are at least start, in order.
+        """
+        i = pos = 0
+        if start is not None:
+            i = bisect.bisect_left(self._maxes, start)
+            if i < len(self._chunks):
+                pos = bisect.bisect_left(self._chunks[i], start)
+        for chunk in self._chunks[i:]:
+            for value in chunk[pos:]:
+                yield value
+            pos = 0
+
+
+class SortedIndex(object):
+    """
+    Keeps objects sorted by a key computed from them, to answer range queries
+    in O(log n + k).  Objects for which the key function returns None are
+    left out of the index.
+    """
+    def __init__(self, key):
+        self.key = key
+        self._sorted = SortedList()  # (key, sequence number, object) entries
+        self._entries = {}  # object -> its entry
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, obj):
+        key = self.key(obj)
+        if key is None:
+            return
+        # The sequence numbers are unique, so the objects are never compared.
+        entry = (key, next(self._counter), obj)
+        self._entries[obj] = entry
+        self._sorted.add(entry)
+
+    def remove(self, obj):
+        entry = self._entries.pop(obj, None)
+        if entry is not None:
+            self._sorted.remove(entry)
+
+    def range(self, start=None, end=None):
+        """
+        Returns the objects whose key is at least start and less than end,
+        sorted by key.
+        """
+        entries = self._sorted.irange(None if start is None else (start,))
+        if end is not None:
+            bound = (end,)
+            entries = itertools.takewhile(lambda entry: entry < bound, entries)
+        return [entry[2] for entry in entries]
+
+    def first(self, count=1, start=None):
+        """
+        Returns the count objects with the lowest keys, which are at least
+        start if given.
+        """
+        entries = self._sorted.irange(None if start is None else (start,))
+        return [entry[2] for entry in itertools.islice(entries, count)]
+
+
+class TextIndex(object):
+    """
+    Inverted index over the words of a text field, for full-text searches
+    with prefix matching and ranked results.
+
+    The index can be given a budget in number of postings (pairs of word and
+    object), past which the words found in the most objects stop being
+    indexed.  Searches for those words are then answered by checking the text
+    of the candidate objects found through the other words of the search.
+    """
+    def __init__(self, field, max_postings=None):
+        self.field = field
+        self.max_postings = max_postings
+        self._docs = {}  # object -> {term: frequency}
+        self._postings = {}  # term -> {object: frequency}
+        self._terms = SortedList()  # for prefix searches
+        self._stopped = set()  # terms left out to stay within the budget
+        self._size = 0  # number of postings
+        self._preloaded = {}  # id -> (checksum, {term: frequency})
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _text(self, obj):
+        text = obj.data.get(self.field)
+        if isinstance(text, string_types):
+            return text
+        return None
+
+    def add(self, obj):
+        text = self._text(obj)
+        if not text:
+            return
+        preloaded = self._preloaded.pop(index_key(obj.data.get('id')), None)
+        if preloaded and preloaded[0] == checksum(text):
+            terms = preloaded[1]
+        else:
+            terms = count_terms(text)
+        terms = dict((term, freq) for term, freq in terms.items()
+                     if term not in self._stopped)
+        self._docs[obj] = terms
+        for term, freq in terms.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._terms.add(term)
+            postings[obj] = freq
+        self._size += len(terms)
+        if self.max_postings and self._size > self.max_postings:
+            self._shrink()
+
+    def remove(self, obj):
+        for term in self._docs.pop(obj, ()):
+            postings = self._postings[term]
+            del postings[obj]
+            self._size -= 1
+            if not postings:
+                self._drop_term(term)
+
+    def _drop_term(self, term):
+        del self._postings[term]
+        self._terms.remove(term)
+
+    def _shrink(self):
+        """
+        Stops indexing the most common terms, until the index is back to 90%
+        of its budget.
+        """
+        target = self.max_postings * 9 // 10
+        by_size = sorted(self._postings, key=lambda t: len(self._postings[t]))
+        while self._size > target and by_size:
+            term = by_size.pop()
+            for obj in self._postings[term]:
+                del self._docs[obj][term]
+            self._size -= len(self._postings[term])
+            self._drop_term(term)
+            self._stopped.add(term)
+
+    def _matching_terms(self, prefix):
+        return itertools.takewhile(lambda term: term.startswith(prefix),
+                                   self._terms.irange(prefix))
+
+    def search(self, query, limit=None):
+        """
+        Returns the objects containing all the words of the query, each of
+        them matching either a whole word or the beginning of one, with the
+        best matches first.
+        """
+        words = list(count_terms(query))
+        if not words:
+            return []
+        total = float(len(self._docs) or 1)
+        scores = None
+        unchecked = []  # words which match terms that are not indexed
+        for word in words:
+            if any(term.startswith(word) for term in self._stopped):
+                unchecked.append(word)
+                continue
+            word_scores = {}
+            for term in self._matching_terms(word):
+                postings = self._postings[term]
+                weight = math.log(total / len(postings)) + 1
+                if term != word:
+                    weight /= 2
+                for obj, freq in postings.items():
+                    word_scores[obj] = word_scores.get(obj, 0) + freq * weight
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict((obj, score + word_scores[obj])
+                              for obj, score in scores.items()
+                              if obj in word_scores)
+            if not scores:
+                return []
+        if scores is None:
+            scores = dict.fromkeys(self._docs, 0)
+        for word in unchecked:
+            scores = dict((obj, score + 1) for obj, score in scores.items()
+                          if any(term.startswith(word) for term in
+                                 count_terms(self._text(obj) or '')))
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return ranked[:limit] if limit else ranked
+
+    def dump(self):
+        """
+        Returns the contents of the index, in a form that can be stored as
+        JSON and passed to preload() to skip indexing the same texts again.
+        """
+        docs = {}
+        for obj, terms in self._docs.items():
+            docs[index_key(obj.data.get('id'))] = [checksum(self._text(obj)), terms]
+        return {'docs': docs, 'stopped': sorted(self._stopped)}
+
+    def preload(self, data):
+        """
+        Loads the contents dumped by a previous index, which are then used
+        instead of parsing the text of the objects added afterwards, as long
+        as it did not change.
+        """
+        self._stopped.update(data.get('stopped', ()))
+        self._preloaded = dict((key, tuple(value)) for key, value in
+                               data.get('docs', {}).items())
+
+    def clear_preloaded(self):
+        self._preloaded = {}
+
+
+def count_terms(text):
+    """
+    Returns the lowercase words of a text, along with the number of times
+    each one of them appears.
+    """
+    terms = {}
+    for term in _WORD_RE.findall(text.lower()):
+        terms[term] = terms.get(term, 0) + 1
+    return terms
+
+
+def checksum(text):
+    return zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+
+class TreeIndex(object):
+    """
+    Keeps the hierarchy of objects which encode it through their ``indent``
+    and ``item_order`` fields, split in separate trees by the value of a field
+    (e.g. the items of each project), or in a single tree if no field is
+    given.
+
+    The parent and children of each object are kept along with it, and only
+    the links around an object are patched when it is added or removed.
+    """
+    def __init__(self, group_field=None, include=None):
+        self.group_field = group_field
+        self.include = include
+        self._trees = {}  # group key -> _Tree
+        self._groups = {}  # object -> group key
+
+    def _group_key(self, obj):
+        if self.group_field is None:
+            return None
+        return index_key(obj.data.get(self.group_field))
+
+    def add(self, obj):
+        if self.include is not None and not self.include(obj):
+            return
+        key = self._group_key(obj)
+        tree = self._trees.get(key)
+        if tree is None:
+            tree = self._trees[key] = _Tree()
+        tree.add(obj)
+        self._groups[obj] = key
+
+    def remove(self, obj):
+        if obj not in self._groups:
+            return
+        key = self._groups.pop(obj)
+        tree = self._trees[key]
+        tree.remove(obj)
+        if not len(tree.objs):
+            del self._trees[key]
+
+    def _tree(self, obj):
+        key = self._groups.get(obj, False)
+        if key is False:
+            return None
+        return self._trees[key]
+
+    def parent(self, obj):
+        tree = self._tree(obj)
+        return tree.parents.get(obj) if tree else None
+
+    def children(self, obj):
+        tree = self._tree(obj)
+        return tree.children_of(obj) if tree else []
+
+    def descendants(self, obj):
+        """
+        Returns the descendants of an object, in depth-first order.
+        """
+        tree = self._tree(obj)
+        if tree is None:
+            return []
+        result = []
+        stack = list(reversed(tree.children_of(obj)))
+        while stack:
+            child = stack.pop()
+            result.append(child)
+            stack.extend(reversed(tree.children_of(child)))
+        return result
+
+    def roots(self, group=None):
+        tree = self._trees.get(None if self.group_field is None
+                               else index_key(group))
+        if tree is None:
+            return []
+        return tree.children_of(None)
+
+
+def _indent(obj):
+    return obj.data.get('indent') or 1
+
+
+class _Tree(object):
+    """
+    Objects of a single tree of a TreeIndex, sorted by order, with the links
+    between them.  The parent of an object is the nearest object before it
+    with a lower indent, which is found by going up the ancestors of the
+    object before it, in O(log n + depth).  Adding an object also goes
+    through the objects after it with a deeper indent, as the ones whose
+    parent came before it become its children, and removing an object gives
+    its children a new parent; the rest of the tree is left as it is.
+    """
+    def __init__(self):
+        self.objs = SortedIndex(lambda obj: obj.data.get('item_order') or 0)
+        self.parents = {}  # object -> parent, None for the roots
+        self.children = {}  # object, None for the roots -> SortedList of entries
+
+    def children_of(self, obj):
+        children = self.children.get(obj)
+        return [entry[2] for entry in children] if children else []
+
+    def _parent(self, entry, indent):
+        """
+        Returns the parent of an object with an indent at the place of an
+        entry of the sorted objects.
+        """
+        before = self.objs._sorted.before(entry)
+        obj = before[2] if before is not None else None
+        while obj is not None and _indent(obj) >= indent:
+            obj = self.parents[obj]
+        return obj
+
+    def _link(self, obj, parent):
+        self.parents[obj] = parent
+        children = self.children.get(parent)
+        if children is None:
+            children = self.children[parent] = SortedList()
+        children.add(self.objs._entries[obj])
+
+    def _unlink(self, obj):
+        parent = self.parents.pop(obj)
+        children = self.children[parent]
+        children.remove(self.objs._entries[obj])
+        if not len(children):
+            del self.children[parent]
+
+    def add(self, obj):
+        self.objs.add(obj)
+        entry = self.objs._entries[obj]
+        indent = _indent(obj)
+        self._link(obj, self._parent(entry, indent))
+        following = self.objs._sorted.irange(entry)
+        next(following)
+        span = set()  # objects between obj and the current one
+        for other_entry in following:
+            other = other_entry[2]
+            if _indent(other) <= indent:
+                break
+            if self.parents[other] not in span:
+                self._unlink(other)
+                self._link(other, obj)
+            span.add(other)
+
+    def remove(self, obj):
+        entry = self.objs._entries.get(obj)
+        if entry is None:
+            return
+        self._unlink(obj)
+        self.objs.remove(obj)
+        children = self.children.pop(obj, ())
+        for child_entry in children:
+            # The objects between obj and its children have deeper indents
+            # than them, so their new parent is found from the object which
+            # came before obj.
+            child = child_entry[2]
+            self._link(child, self._parent(entry, _indent(child)))
+
+
+EARTH_RADIUS = 6371000.0  # meters
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Returns the distance in meters between two points, with the haversine
+    formula.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex(object):
+    """
+    Spatial index which places objects in the cells of a grid of latitudes
+    and longitudes, so that searches around a point only need to check the
+    objects of the nearby cells.  The coords function returns the latitude
+    and longitude of an object, or None if it has no location.
+    """
+    def __init__(self, coords, cell_size=0.01):
+        self.coords = coords
+        self.cell_size = cell_size  # in degrees, about 1.1 km of latitude
+        self._lon_cells = int(round(360 / cell_size))
+        self._cells = {}  # cell -> set of objects
+        self._points = {}  # object -> (lat, lon, cell)
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)) % self._lon_cells)
+
+    def add(self, obj):
+        coords = self.coords(obj)
+        if coords is None:
+            return
+        lat, lon = coords
+        cell = self._cell(lat, lon)
+        self._cells.setdefault(cell, set()).add(obj)
+        self._points[obj] = (lat, lon, cell)
+
+    def remove(self, obj):
+        point = self._points.pop(obj, None)
+        if point is None:
+            return
+        objs = self._cells[point[2]]
+        objs.discard(obj)
+        if not objs:
+            del self._cells[point[2]]
+
+    def _ring(self, lat, lon, ring):
+        """
+        Returns the objects in the cells at a given distance, in cells, from
+        the cell of a point.
+        """
+        row, col = self._cell(lat, lon)
+        for r in range(row - ring, row + ring + 1):
+            edge = r in (row - ring, row + ring)
+            for c in range(col - ring, col + ring + 1, 1 if edge else 2 * ring or 1):
+                objs = self._cells.get((r, c % self._lon_cells))
+                if objs:
+                    for obj in objs:
+                        yield obj
+
+    def _rings_for(self, lat, distance_m):
+        """
+        Returns how many rings of cells around a point cover a distance, at
+        most as many as cover the whole globe.
+        """
+        lat_deg = distance_m / 111320.0
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + lat_deg, 89.9))), 0.01)
+        lon_deg = lat_deg / cos_lat
+        return min(int(math.ceil(max(lat_deg, lon_deg) / self.cell_size)),
+                   self._max_rings(lat))
+
+    def _max_rings(self, lat):
+        """
+        Returns how many rings of cells around a point cover the whole globe.
+        """
+        row = int(math.floor(lat / self.cell_size))
+        pole_rows = int(math.ceil(90 / self.cell_size))
+        return max(pole_rows - row, pole_rows + row, self._lon_cells // 2)
+
+    def _scan_cost(self, rings):
+        """
+        Returns whether looking up the cells of a number of rings costs more
+        than going through all the objects.
+        """
+        return (2 * rings + 1) ** 2 > len(self._points)
+
+    def within(self, lat, lon, distance_m):
+        """
+        Returns the (distance, object) pairs of the objects at most a
+        distance in meters away from a point, nearest first.
+        """
+        rings = self._rings_for(lat, distance_m)
+        if self._scan_cost(rings):
+            objs = list(self._points)
+        else:
+            objs = itertools.chain.from_iterable(self._ring(lat, lon, ring)
+                                                 for ring in range(rings + 1))
+        result = []
+        for obj in objs:
+            plat, plon, _ = self._points[obj]
+            d = distance(lat, lon, plat, plon)
+            if d <= distance_m:
+                result.append((d, obj))
+        result.sort(key=lambda pair: pair[0])
+        return result
+
+    def nearest(self, lat, lon, count=1):
+        """
+        Returns the (distance, object) pairs of the count objects nearest to a
+        point, nearest first.
+        """
+        found = []
+        ring = 0
+        max_rings = self._max_rings(lat)
+        while ring <= max_rings and len(found) < len(self._points):
+            if self._scan_cost(ring):
+                # Further rings would cost more than all the objects.
+                found = [(distance(lat, lon, plat, plon), obj)
+                         for obj, (plat, plon, _) in self._points.items()]
+                found.sort(key=lambda pair: pair[0])
+                break
+            for obj in self._ring(lat, lon, ring):
+                plat, plon, _ = self._points[obj]
+                found.append((distance(lat, lon, plat, plon), obj))
+            found.sort(key=lambda pair: pair[0])
+            # Once enough objects are found, any object in a further ring is
+            # known to be further away than them.
+            if len(found) >= count and \
+                    self._rings_for(lat, found[count - 1][0]) <= ring:
+                break
+            ring += 1
+        return found[:count]
+
+
+class DigestIndex(object):
+    """
+    Keeps a hash of the contents of each object, rolled up in a fixed number
+    of buckets (each the XOR of the hashes of its objects) and in a root hash
+    of the buckets, so that comparing two sets of objects only needs to look
+    at the objects of the buckets which differ.
+
+    Objects are only hashed when the digest is asked for, so that merges only
+    need to mark the objects which changed.
+    """
+    BUCKETS = 256
+
+    def __init__(self, key):
+        self.key = key  # function returning a unique key for an object
+        self._hashes = {}  # key -> hash
+        self._pending = {}  # key -> object whose hash is to be computed
+        self._buckets = [0] * self.BUCKETS
+        self._bucket_keys = [set() for _ in range(self.BUCKETS)]
+
+    def bucket(self, key):
+        return checksum(key) % self.BUCKETS
+
+    def add(self, obj):
+        self._pending[self.key(obj)] = obj
+
+    def remove(self, obj):
+        key = self.key(obj)
+        if self._pending.pop(key, None) is None and key in self._hashes:
+            bucket = self.bucket(key)
+            self._buckets[bucket] ^= self._hashes.pop(key)
+            self._bucket_keys[bucket].discard(key)
+
+    def _settle(self):
+        for key, obj in self._pending.items():
+            obj_hash = content_hash(obj.data)
+            bucket = self.bucket(key)
+            self._buckets[bucket] ^= obj_hash
+            self._bucket_keys[bucket].add(key)
+            self._hashes[key] = obj_hash
+        self._pending = {}
+
+    def root(self):
+        """
+        Returns the root hash of all the objects, as a hex string.
+        """
+        self._settle()
+        return '%016x' % (reduce_hashes(self._buckets) if self._hashes else 0)
+
+    def snapshot(self):
+        """
+        Returns the digest in a form that can be stored as JSON, and later
+        compared with diff().
+        """
+        self._settle()
+        return {'root': self.root(),
+                'buckets': ['%016x' % h for h in self._buckets],
+                'objects': [dict((key, '%016x' % self._hashes[key]) for key in keys)
+                            for keys in self._bucket_keys]}
+
+    def diff(self, snapshot):
+        """
+        Returns the keys of the objects added, updated and deleted since a
+        snapshot, only looking at the buckets whose hash changed.
+        """
+        self._settle()
+        added, updated, deleted = [], [], []
+        if snapshot.get('root') == self.root():
+            return added, updated, deleted
+        for bucket, old_hash in enumerate(snapshot['buckets']):
+            if int(old_hash, 16) == self._buckets[bucket]:
+                continue
+            keys = self._bucket_keys[bucket]
+            old_objects = snapshot['objects'][bucket]
+            for key in keys:
+                if key not in old_objects:
+                    added.append(key)
+                elif int(old_objects[key], 16) != self._hashes[key]:
+                    updated.append(key)
+            deleted.extend(key for key in old_objects if key not in keys)
+        return added, updated, deleted
+
+
+def reduce_hashes(hashes):
+    """
+    Combines a sequence of 64-bit hashes in a single one, which depends on
+    their order.
+    """
+    return content_hash(['%016x' % h for h in hashes])
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from ..indexes import index_key
 from .generic import Manager, SyncMixin
 
 
@@ -12,7 +13,59 @@ class CollaboratorStatesManager(Manager, SyncMixin):
         Finds and returns the collaborator state based on the project and user
         ids.
         """
-        for obj in self.state[self.state_name]:
-            if obj['project_id'] == project_id and obj['user_id'] == user_id:
-                return obj
-        return None
+        return self._by_ids.get((index_key(project_id), index_key(user_id)))
+
+    def get_by_project(self, project_id):
+        """
+        Returns the collaborator states of all the members of a project.
+        """
+        return list(self._by_project.get(index_key(project_id), {}).values())
+
+    def get_by_user(self, user_id):
+        """
+        Returns the collaborator states of a user in all the projects shared
+        with them.
+        """
+        return list(self._by_user.get(index_key(user_id), {}).values())
+
+    @staticmethod
+    def _object_key(obj):
+        return '%s:%s' % (index_key(obj['project_id']), index_key(obj['user_id']))
+
+    @staticmethod
+    def _key_data(key):
+        project_id, user_id = key.split(':', 1)
+        return {'project_id': project_id, 'user_id': user_id}
+
+    def _find_local(self, obj):
+        return self.get_by_ids(obj['project_id'], obj['user_id'])
+
+    def _is_local(self, obj):
+        return self._find_local(obj) is obj
+
+    def _reset_index(self):
+        super(CollaboratorStatesManager, self)._reset_index()
+        self._by_ids = {}
+        self._by_project = {}
+        self._by_user = {}
+
+    def _index(self, obj):
+        super(CollaboratorStatesManager, self)._index(obj)
+        project_key = index_key(obj['project_id'])
+        user_key = index_key(obj['user_id'])
+        self._by_ids[(project_key, user_key)] = obj
+        self._by_project.setdefault(project_key, {})[user_key] = obj
+        self._by_user.setdefault(user_key, {})[project_key] = obj
+
+    def _unindex(self, obj):
+        super(CollaboratorStatesManager, self)._unindex(obj)
+        project_key = index_key(obj['project_id'])
+        user_key = index_key(obj['user_id'])
+        if self._by_ids.get((project_key, user_key)) is obj:
+            del self._by_ids[(project_key, user_key)]
+            del self._by_project[project_key][user_key]
+            if not self._by_project[project_key]:
+                del self._by_project[project_key]
+            del self._by_user[user_key][project_key]
+            if not self._by_user[user_key]:
+                del self._by_user[user_key]
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import weakref
+
 from .. import models
 from .generic import Manager, AllMixin, GetByIdMixin, SyncMixin
 
@@ -7,6 +9,7 @@ class FiltersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
 
     state_name = 'filters'
     object_type = 'filter'
+    _views = None
 
     def add(self, name, query, **kwargs):
         """
@@ -15,7 +18,7 @@ class FiltersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         obj = models.Filter({'name': name, 'query': query}, self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'filter_add',
             'temp_id': obj.temp_id,
@@ -25,6 +28,25 @@ class FiltersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         self.queue.append(cmd)
         return obj
 
+    def view(self, filter_id):
+        """
+        Returns a materialized view of the local items matching a saved
+        filter, which is kept up to date as the local state changes, and
+        follows the changes of the filter's query.  There is a single view
+        for each filter, which is closed once the filter is deleted.
+        """
+        obj = self.get_by_id(filter_id, only_local=True)
+        if obj is None:
+            return None
+        if self._views is None:
+            self._views = _FilterViews(self)
+            self._watch(self._views)
+        view = self._views.views.get(obj)
+        if view is None:
+            view = self._views.views[obj] = \
+                self.api.items.view(lambda: obj['query'])
+        return view
+
     def update(self, filter_id, **kwargs):
         """
         Updates a filter remotely.
@@ -42,6 +64,9 @@ class FiltersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         """
         Deletes a filter remotely.
         """
+        obj = self.get_by_id(filter_id, only_local=True)
+        if obj is not None and self._views is not None:
+            self._views.close(obj)
         cmd = {
             'type': 'filter_delete',
             'uuid': self.api.generate_uuid(),
@@ -78,3 +103,38 @@ class FiltersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
             data['filters'].append(obj.get('filter'))
         self.api._update_state(data)
         return obj
+
+
+class _FilterViews(object):
+    """
+    Views of the saved filters, which are closed once their filter is
+    deleted or leaves the local state, as a watcher of the filters manager.
+    """
+    def __init__(self, manager):
+        self.manager = weakref.proxy(manager)
+        self.views = {}  # filter -> QueryView
+        self._removed = []
+
+    def close(self, obj):
+        view = self.views.pop(obj, None)
+        if view is not None:
+            view.close()
+
+    def add(self, obj):
+        pass
+
+    def remove(self, obj):
+        if obj in self.views:
+            self._removed.append(obj)
+
+    def flush(self):
+        removed, self._removed = self._removed, []
+        for obj in removed:
+            if obj.data.get('is_deleted') or not self.manager._is_local(obj):
+                self.close(obj)
+
+    def reset(self):
+        for view in self.views.values():
+            view.close()
+        self.views = {}
+        self._removed = []
@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
+import itertools
+import weakref
+
+from ..indexes import DigestIndex, FieldIndex, TextIndex, index_key
+
+
 class Manager(object):
 
     # should be re-defined in a subclass
     state_name = None
     object_type = None
+    #: fields of the objects which secondary indexes are kept for
+    indexed_fields = ()
+    #: values of the indexed fields assumed for the objects without them
+    field_defaults = {}
+    #: text field of the objects which a full-text index is kept for
+    text_field = None
 
     def __init__(self, api):
-        self.api = api
+        self.api = weakref.proxy(api)  # the api keeps the managers alive
+        self._generation = 0  # changes whenever the local objects change
+        self._watchers = []  # kept informed of the changes to the objects
+        self._reset_index()
 
     # shortcuts
     @property
@@ -21,10 +36,212 @@ class Manager(object):
     def token(self):
         return self.api.token
 
+    # local lookup tables
+    def _reset_index(self):
+        """
+        Drops the lookup tables kept for the objects of the local state.
+        """
+        self._generation += 1
+        self._ids = {}
+        self._indexes = self._create_indexes()
+        for watcher in self._watchers:
+            watcher.reset()
+
+    def _create_indexes(self):
+        """
+        Returns the secondary indexes to keep for the objects of the local
+        state, by name.  By default there is a field index for each one of
+        the indexed_fields, and a digest of the contents of the objects.
+        """
+        indexes = dict((field, FieldIndex(field, self.field_defaults.get(field)))
+                       for field in self.indexed_fields)
+        indexes['digest'] = DigestIndex(self._object_key)
+        if self.text_field:
+            indexes['text'] = TextIndex(self.text_field, self.api.search_budget)
+        return indexes
+
+    def _rebuild_index(self):
+        """
+        Recreates the lookup tables from the objects of the local state.
+        """
+        self._reset_index()
+        for obj in self.state[self.state_name]:
+            self._index(obj)
+        self._notify_watchers()
+
+    def _index(self, obj, tiering=False):
+        """
+        Registers an object of the local state in the lookup tables, both
+        under its id and its temporary id.  tiering is set when the object
+        is brought back from the cold tier.
+        """
+        self._generation += 1
+        if 'id' in obj.data:
+            self._ids[index_key(obj.data['id'])] = obj
+        if obj.temp_id:
+            self._ids[obj.temp_id] = obj
+        for index in self._indexes.values():
+            index.add(obj)
+        for watcher in self._watchers:
+            if not (tiering and getattr(watcher, 'ignores_tiering', False)):
+                watcher.add(obj)
+
+    @staticmethod
+    def _object_key(obj):
+        """
+        Returns the key which identifies an object in the digest of the
+        local state.  Being static, the digest does not refer back to the
+        manager.
+        """
+        if 'id' in obj.data:
+            return index_key(obj.data['id'])
+        return obj.temp_id
+
+    @staticmethod
+    def _key_data(key):
+        """
+        Returns the fields which identify the object with the given key (as
+        returned by _object_key) when merged into the local state.
+        """
+        return {'id': key}
+
+    def _thaw(self, obj_id):
+        """
+        Brings an object back from the cold tier into the local state, and
+        returns it, or returns None if it is not there.
+        """
+        if self.api.tiers is None or self.state_name not in self.api._datatype_models:
+            return None
+        data = self.api.tiers.pop(self.state_name, index_key(obj_id))
+        if data is None:
+            return None
+        obj = self.api._datatype_models[self.state_name](data, self.api)
+        self.state[self.state_name].append(obj)
+        self._index(obj, tiering=True)
+        return obj
+
+    def _cold_objects(self):
+        """
+        Returns the objects in the cold tier, without bringing them back into
+        the local state.
+        """
+        if self.api.tiers is None or self.state_name not in self.api._datatype_models:
+            return []
+        model = self.api._datatype_models[self.state_name]
+        return (model(data, self.api) for data in self.api.tiers.values(self.state_name))
+
+    def _add_local(self, obj):
+        """
+        Adds an object created locally to the local state, so that its
+        temporary id can be replaced by the real one after the next sync.
+        """
+        self.state[self.state_name].append(obj)
+        self._index(obj)
+        self.api._temp_id_objects[obj.temp_id] = obj
+        self._notify_watchers()
+
+    def _find_local(self, obj):
+        """
+        Finds the local object that corresponds to an object returned by the
+        server, or returns None if there is none.
+        """
+        return self._ids.get(index_key(obj['id']))
+
+    def _unindex(self, obj, tiering=False):
+        """
+        Removes an object of the local state from the lookup tables.
+        tiering is set when the object is moved to the cold tier.
+        """
+        self._generation += 1
+        for key in (index_key(obj.data.get('id')), obj.temp_id):
+            if self._ids.get(key) is obj:
+                del self._ids[key]
+        for index in self._indexes.values():
+            index.remove(obj)
+        for watcher in self._watchers:
+            if not (tiering and getattr(watcher, 'ignores_tiering', False)):
+                watcher.remove(obj)
+
+    def _update_local(self, obj, data, notify=True):
+        """
+        Updates the data of an object, keeping the lookup tables in sync with
+        it if it belongs to the local state.
+        """
+        if not self._is_local(obj):
+            obj.data.update(data)
+            return
+        self._unindex(obj)
+        obj.data.update(data)
+        self._index(obj)
+        if notify:
+            self._notify_watchers()
+
+    def _watch(self, watcher):
+        """
+        Registers an object whose add() and remove() methods are called as
+        the objects of the local state change, and whose flush() method is
+        called after each batch of changes.  If its ignores_tiering attribute
+        is set, it is not told about the objects moved to or brought back
+        from the cold tier.
+        """
+        self._watchers.append(watcher)
+
+    def _unwatch(self, watcher):
+        self._watchers.remove(watcher)
+
+    def _notify_watchers(self):
+        for watcher in self._watchers:
+            watcher.flush()
+
+    def _is_local(self, obj):
+        """
+        Returns whether the object is registered in the lookup tables.
+        """
+        return (self._ids.get(index_key(obj.data.get('id'))) is obj or
+                self._ids.get(obj.temp_id) is obj)
+
+    def _lookup(self, field, value):
+        """
+        Returns the objects of the local state whose field has the value,
+        using the secondary index kept for that field.
+        """
+        return list(self._indexes[field].get(value))
+
+    def _select(self, criteria):
+        """
+        Returns the set of objects of the local state matching all the
+        criteria, which map indexed fields to a value, or to a list of values
+        any of which may match.  The cost is proportional to the size of the
+        smallest set of objects involved, not to the size of the state.
+        """
+        matches = []
+        for field, value in criteria.items():
+            index = self._indexes[field]
+            if isinstance(value, (list, tuple, set, frozenset)):
+                objs = set()
+                for v in value:
+                    objs |= index.get(v)
+            else:
+                objs = index.get(value)
+            matches.append(objs)
+        if not matches:
+            return set(self.state[self.state_name])
+        matches.sort(key=len)
+        result = set(matches[0])
+        for objs in matches[1:]:
+            if not result:
+                break
+            result &= objs
+        return result
+
 
 class AllMixin(object):
     def all(self, filt=None):
-        return list(filter(filt, self.state[self.state_name]))
+        """
+        Returns the local objects, including the ones in the cold tier.
+        """
+        objs = itertools.chain(self.state[self.state_name], self._cold_objects())
+        return list(filter(filt, objs))
 
 
 class GetByIdMixin(object):
@@ -32,9 +249,13 @@ class GetByIdMixin(object):
         """
         Finds and returns the object based on its id.
         """
-        for obj in self.state[self.state_name]:
-            if obj['id'] == obj_id or obj.temp_id == str(obj_id):
-                return obj
+        obj = self._ids.get(index_key(obj_id))
+        if obj is None:
+            obj = self._thaw(obj_id)
+            if obj is not None:
+                self._notify_watchers()
+        if obj is not None:
+            return obj
 
         if not only_local and self.object_type is not None:
             getter = getattr(eval('self.api.%ss' % self.object_type) , 'get')
@@ -43,6 +264,48 @@ class GetByIdMixin(object):
         return None
 
 
+class HierarchyMixin(object):
+    """
+    Navigates the hierarchy of objects defined by their indents and orders.
+    """
+    def get_parent(self, obj_id):
+        """
+        Returns the parent of a local object, or None for top-level objects.
+        """
+        return self._indexes['tree'].parent(self.get_by_id(obj_id, only_local=True))
+
+    def get_children(self, obj_id):
+        """
+        Returns the direct children of a local object, in order.
+        """
+        return self._indexes['tree'].children(self.get_by_id(obj_id, only_local=True))
+
+    def get_descendants(self, obj_id):
+        """
+        Returns all the descendants of a local object, in order.
+        """
+        return self._indexes['tree'].descendants(self.get_by_id(obj_id, only_local=True))
+
+    def _update_orders_indents(self, ids_to_orders_indents):
+        """
+        Updates in the local state the orders and indents of multiple objects.
+        """
+        for obj_id, (order, indent) in ids_to_orders_indents.items():
+            obj = self.get_by_id(obj_id, only_local=True)
+            if obj is not None:
+                self._update_local(obj, {'item_order': order, 'indent': indent})
+
+
+class SearchMixin(object):
+    def search(self, query, limit=None):
+        """
+        Returns the local objects whose text contains all the words of the
+        query, either whole or as the beginning of a longer word, with the
+        best matches first.
+        """
+        return self._indexes['text'].search(query, limit)
+
+
 class SyncMixin(object):
     """
     Syncs this specific type of objects.
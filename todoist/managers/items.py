@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
-from .. import models
-from .generic import Manager, AllMixin, GetByIdMixin, SyncMixin
+import time
 
+from .. import dates, models
+from ..columns import ColumnStore
+from ..indexes import SortedIndex, TreeIndex
+from ..query import QueryEngine, QueryView
+from .generic import (Manager, AllMixin, GetByIdMixin, HierarchyMixin,
+                      SearchMixin, SyncMixin)
 
-class ItemsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
+
+class ItemsManager(Manager, AllMixin, GetByIdMixin, HierarchyMixin, SearchMixin,
+                   SyncMixin):
 
     state_name = 'items'
     object_type = 'item'
+    indexed_fields = ('project_id', 'labels', 'priority', 'checked',
+                      'in_history')
+    # The items added locally have neither field until they are synced.
+    field_defaults = {'checked': 0, 'in_history': 0}
+    text_field = 'content'
+    _query_engine = None
+    _columns = None
 
     def add(self, content, project_id, **kwargs):
         """
@@ -16,7 +30,7 @@ class ItemsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
                           self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'item_add',
             'temp_id': obj.temp_id,
@@ -26,6 +40,109 @@ class ItemsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         self.queue.append(cmd)
         return obj
 
+    def by_project(self, project_id):
+        """
+        Returns the local items of a project.
+        """
+        return self._lookup('project_id', project_id)
+
+    def _create_indexes(self):
+        indexes = super(ItemsManager, self)._create_indexes()
+        indexes['due'] = SortedIndex(_due_timestamp)
+        indexes['tree'] = TreeIndex('project_id', _in_tree)
+        return indexes
+
+    def get_roots(self, project_id):
+        """
+        Returns the top-level local items of a project, in order.
+        """
+        return self._indexes['tree'].roots(project_id)
+
+    def due_between(self, start=None, end=None):
+        """
+        Returns the local uncompleted items due at or after start and before
+        end (both in seconds since the epoch), sorted by due date.
+        """
+        return self._indexes['due'].range(start, end)
+
+    def overdue(self, now=None):
+        """
+        Returns the local uncompleted items whose due date has passed, sorted
+        by due date.
+        """
+        return self.due_between(None, now or time.time())
+
+    def due_today(self, now=None):
+        """
+        Returns the local uncompleted items due today, in the user's
+        timezone, sorted by due date.
+        """
+        return self.due_next(1, now)
+
+    def due_next(self, days=7, now=None):
+        """
+        Returns the local uncompleted items due from today up to the given
+        number of days, in the user's timezone, sorted by due date.
+        """
+        today = dates.day_start(now or time.time(),
+                                dates.user_offset(self.state['user']))
+        return self.due_between(today, today + days * dates.DAY)
+
+    def next_due(self, count=1, now=None):
+        """
+        Returns the count local uncompleted items which are due next.
+        """
+        return self._indexes['due'].first(count, now or time.time())
+
+    def query(self, query, now=None):
+        """
+        Returns the local uncompleted items matching a filter query, such as
+        ``today | overdue``, ``p1 & #Work`` or ``@waiting``, sorted by due
+        date.  The query is evaluated on the local state, without contacting
+        the server, and a QueryError is raised if it is not valid.
+        """
+        return self._get_query_engine().evaluate(query, now)
+
+    def view(self, query):
+        """
+        Returns a materialized view of the local uncompleted items matching a
+        filter query, which is kept up to date as the local state changes.
+        """
+        return QueryView(self._get_query_engine(), query)
+
+    def _get_query_engine(self):
+        if self._query_engine is None:
+            self._query_engine = QueryEngine(self)
+        return self._query_engine
+
+    def columns(self, use_numpy=None):
+        """
+        Returns a columnar copy of the local items, for filters and group-bys
+        over large numbers of items, e.g. ``columns().count_by('project_id',
+        'priority', checked=0)``.  It is built on first use, and then kept up
+        to date as the local state changes.  NumPy is used when it is
+        installed, unless use_numpy is False.
+        """
+        if self._columns is None or (use_numpy is not None and
+                                     use_numpy != self._columns.use_numpy):
+            if self._columns is not None:
+                self._unwatch(self._columns)
+            self._columns = ColumnStore(use_numpy)
+            for item in self.state[self.state_name]:
+                self._columns.add(item)
+            self._watch(self._columns)
+        return self._columns
+
+    def select(self, **criteria):
+        """
+        Returns the set of local items matching all the criteria, e.g.
+        ``select(priority=4, labels=label_id, checked=0)``.  Passing a list of
+        values matches any of them, e.g. ``select(priority=[3, 4])``, and the
+        returned sets can be further combined with ``&``, ``|`` and ``-``.
+        The supported fields are those in ``indexed_fields``.
+        """
+        return self._select(criteria)
+
     def update(self, item_id, **kwargs):
         """
         Updates an item remotely.
@@ -135,6 +252,7 @@ class ItemsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         """
         Updates the order and indents of multiple items remotely.
         """
+        self._update_orders_indents(ids_to_orders_indents)
         cmd = {
             'type': 'item_update_orders_indents',
             'uuid': self.api.generate_uuid(),
@@ -184,3 +302,21 @@ class ItemsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
             data['notes'] += obj.get('notes')
         self.api._update_state(data)
         return obj
+
+
+def _due_timestamp(item):
+    """
+    Returns the due date of an uncompleted item in seconds since the epoch,
+    or None if it has no due date or it is completed or deleted.
+    """
+    if item.data.get('checked') or item.data.get('is_deleted'):
+        return None
+    return item.due_timestamp
+
+
+def _in_tree(item):
+    """
+    Returns whether an item shows up in the tree of its project, that is, if
+    it is neither deleted nor moved to history.
+    """
+    return not item.data.get('is_deleted') and not item.data.get('in_history')
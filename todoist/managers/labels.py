@@ -15,7 +15,7 @@ class LabelsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         obj = models.Label({'name': name}, self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'label_add',
             'temp_id': obj.temp_id,
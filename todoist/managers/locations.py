@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from ..indexes import GridIndex
 from .generic import Manager, AllMixin, SyncMixin
 
 
@@ -7,6 +8,32 @@ class LocationsManager(Manager, AllMixin, SyncMixin):
     state_name = 'locations'
     object_type = None  # there is no local state associated
 
+    _grid = None
+    _grid_source = None
+
+    def near(self, lat, lon, radius):
+        """
+        Returns the locations placed at most radius meters away from a point,
+        nearest first.
+        """
+        return [list(loc) for _, loc in self._get_grid().within(lat, lon, radius)]
+
+    def nearest(self, lat, lon, count=1):
+        """
+        Returns the count locations nearest to a point, nearest first.
+        """
+        return [list(loc) for _, loc in self._get_grid().nearest(lat, lon, count)]
+
+    def _get_grid(self):
+        # The locations are replaced as a whole on every sync, so the grid is
+        # built again whenever they were.
+        if self._grid_source is not self.state[self.state_name]:
+            self._grid = GridIndex(_location)
+            for loc in self.state[self.state_name]:
+                self._grid.add(tuple(loc))
+            self._grid_source = self.state[self.state_name]
+        return self._grid
+
     def clear(self):
         """
         Clears the locations.
@@ -17,3 +44,13 @@ class LocationsManager(Manager, AllMixin, SyncMixin):
             'args': {},
         }
         self.queue.append(cmd)
+
+
+def _location(loc):
+    """
+    Returns the latitude and longitude of a ``[name, lat, lon]`` location.
+    """
+    try:
+        return float(loc[1]), float(loc[2])
+    except (IndexError, TypeError, ValueError):
+        return None
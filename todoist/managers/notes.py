@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 from .. import models
-from .generic import Manager, AllMixin, GetByIdMixin, SyncMixin
+from .generic import Manager, AllMixin, GetByIdMixin, SearchMixin, SyncMixin
 
 
-class GenericNotesManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
+class GenericNotesManager(Manager, AllMixin, GetByIdMixin, SearchMixin,
+                          SyncMixin):
 
     object_type = 'note'
+    text_field = 'content'
 
     def update(self, note_id, **kwargs):
         """
@@ -37,6 +39,7 @@ class GenericNotesManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
 class NotesManager(GenericNotesManager):
 
     state_name = 'notes'
+    indexed_fields = ('item_id',)
 
     def add(self, item_id, content, **kwargs):
         """
@@ -45,7 +48,7 @@ class NotesManager(GenericNotesManager):
         obj = models.Note({'item_id': item_id, 'content': content}, self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'note_add',
             'temp_id': obj.temp_id,
@@ -55,6 +58,12 @@ class NotesManager(GenericNotesManager):
         self.queue.append(cmd)
         return obj
 
+    def by_item(self, item_id):
+        """
+        Returns the local notes of an item.
+        """
+        return self._lookup('item_id', item_id)
+
     def get(self, note_id):
         """
         Gets an existing note.
@@ -74,6 +83,7 @@ class NotesManager(GenericNotesManager):
 class ProjectNotesManager(GenericNotesManager):
 
     state_name = 'project_notes'
+    indexed_fields = ('project_id',)
 
     def add(self, project_id, content, **kwargs):
         """
@@ -83,7 +93,7 @@ class ProjectNotesManager(GenericNotesManager):
                                  self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'note_add',
             'temp_id': obj.temp_id,
@@ -92,3 +102,9 @@ class ProjectNotesManager(GenericNotesManager):
         }
         self.queue.append(cmd)
         return obj
+
+    def by_project(self, project_id):
+        """
+        Returns the local notes of a project.
+        """
+        return self._lookup('project_id', project_id)
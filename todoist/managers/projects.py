@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from .. import models
-from .generic import Manager, AllMixin, GetByIdMixin, SyncMixin
+from ..indexes import TreeIndex
+from .generic import Manager, AllMixin, GetByIdMixin, HierarchyMixin, SyncMixin
 
 
-class ProjectsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
+class ProjectsManager(Manager, AllMixin, GetByIdMixin, HierarchyMixin,
+                      SyncMixin):
 
     state_name = 'projects'
     object_type = 'project'
@@ -15,7 +17,7 @@ class ProjectsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         obj = models.Project({'name': name}, self.api)
         obj.temp_id = obj['id'] = '$' + self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'project_add',
             'temp_id': obj.temp_id,
@@ -25,13 +27,24 @@ class ProjectsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         self.queue.append(cmd)
         return obj
 
+    def _create_indexes(self):
+        indexes = super(ProjectsManager, self)._create_indexes()
+        indexes['tree'] = TreeIndex(include=_in_tree)
+        return indexes
+
+    def get_roots(self):
+        """
+        Returns the top-level local projects, in order.
+        """
+        return self._indexes['tree'].roots()
+
     def update(self, project_id, **kwargs):
         """
         Updates a project remotely.
         """
         obj = self.get_by_id(project_id)
         if obj:
-            obj.data.update(kwargs)
+            self._update_local(obj, kwargs)
 
         args = {'id': project_id}
         args.update(kwargs)
@@ -85,6 +98,7 @@ class ProjectsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         """
         Updates the orders and indents of multiple projects remotely.
         """
+        self._update_orders_indents(ids_to_orders_indents)
         cmd = {
             'type': 'project_update_orders_indents',
             'uuid': self.api.generate_uuid(),
@@ -140,3 +154,11 @@ class ProjectsManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
             data['project_notes'] += obj.get('notes')
         self.api._update_state(data)
         return obj
+
+
+def _in_tree(project):
+    """
+    Returns whether a project shows up in the projects tree, that is, if it
+    is neither deleted nor archived.
+    """
+    return not project.data.get('is_deleted') and not project.data.get('is_archived')
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from .. import models
+from ..indexes import GridIndex
 from .generic import Manager, AllMixin, GetByIdMixin, SyncMixin
 
 
@@ -7,6 +8,7 @@ class RemindersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
 
     state_name = 'reminders'
     object_type = 'reminder'
+    indexed_fields = ('item_id',)
 
     def add(self, item_id, **kwargs):
         """
@@ -15,7 +17,7 @@ class RemindersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         obj = models.Reminder({'item_id': item_id}, self.api)
         obj.temp_id = obj['id'] = self.api.generate_uuid()
         obj.data.update(kwargs)
-        self.state[self.state_name].append(obj)
+        self._add_local(obj)
         cmd = {
             'type': 'reminder_add',
             'temp_id': obj.temp_id,
@@ -25,6 +27,31 @@ class RemindersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
         self.queue.append(cmd)
         return obj
 
+    def by_item(self, item_id):
+        """
+        Returns the local reminders of an item.
+        """
+        return self._lookup('item_id', item_id)
+
+    def _create_indexes(self):
+        indexes = super(RemindersManager, self)._create_indexes()
+        indexes['location'] = GridIndex(_location)
+        return indexes
+
+    def near(self, lat, lon, radius):
+        """
+        Returns the local location reminders placed at most radius meters
+        away from a point, nearest first.
+        """
+        return [obj for _, obj in self._indexes['location'].within(lat, lon, radius)]
+
+    def nearest(self, lat, lon, count=1):
+        """
+        Returns the count local location reminders nearest to a point,
+        nearest first.
+        """
+        return [obj for _, obj in self._indexes['location'].nearest(lat, lon, count)]
+
     def update(self, reminder_id, **kwargs):
         """
         Updates a reminder remotely.
@@ -65,3 +92,16 @@ class RemindersManager(Manager, AllMixin, GetByIdMixin, SyncMixin):
             data['reminders'].append(obj.get('reminder'))
         self.api._update_state(data)
         return obj
+
+
+def _location(reminder):
+    """
+    Returns the latitude and longitude of a location reminder, or None for
+    other reminders.
+    """
+    if reminder.data.get('type') != 'location' or reminder.data.get('is_deleted'):
+        return None
+    try:
+        return float(reminder.data['loc_lat']), float(reminder.data['loc_long'])
+    except (KeyError, TypeError, ValueError):
+        return None
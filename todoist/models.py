@@ -1,14 +1,39 @@
+import json
+import hashlib
+import weakref
 from pprint import pformat
 
+from . import dates
+
+
+def content_hash(data):
+    """
+    Returns a stable 64-bit hash of a JSON-like value.
+    """
+    serialized = json.dumps(data, sort_keys=True, separators=(',', ':'),
+                            default=str)
+    return int(hashlib.sha1(serialized.encode('utf-8')).hexdigest()[:16], 16)
+
 
 class Model(object):
     """
     Implements a generic object.
+
+    Models are slotted, as there is one for each object of the local state.
+    Subclasses have to declare their own (empty) __slots__ for this to hold.
+    They only keep a weak proxy of the api, so that the local state does not
+    form reference cycles through them, and is freed along with the api.
     """
+    __slots__ = ('temp_id', 'data', 'api', '_dates')
+
+    #: fields holding dates, which are parsed in bulk after each sync
+    date_fields = ()
+
     def __init__(self, data, api):
         self.temp_id = ''
         self.data = data
-        self.api = api
+        self.api = api if type(api) in weakref.ProxyTypes else weakref.proxy(api)
+        self._dates = None  # field -> (text, timestamp) it was last parsed to
 
     def __setitem__(self, key, value):
         self.data[key] = value
@@ -16,6 +41,41 @@ class Model(object):
     def __getitem__(self, key):
         return self.data[key]
 
+    def timestamp(self, field):
+        """
+        Returns the date of a field in seconds since the epoch, or None if it
+        is empty or cannot be parsed.  The result is cached along with the
+        text it comes from, so the field is only parsed again once it changes.
+        """
+        value = self.data.get(field)
+        if self._dates is None:
+            self._dates = {}
+        cached = self._dates.get(field)
+        if cached is None or cached[0] != value:
+            cached = self._dates[field] = (value, dates.parse_timestamp(value))
+        return cached[1]
+
+    def datetime(self, field):
+        """
+        Returns the date of a field as an aware datetime in UTC, or None.
+        """
+        return dates.to_datetime(self.timestamp(field))
+
+    def parse_dates(self):
+        """
+        Parses all the date_fields of the object ahead of their first use.
+        """
+        for field in self.date_fields:
+            self.timestamp(field)
+
+    @property
+    def content_hash(self):
+        """
+        Hash of the data of the object, which stays the same across processes
+        and only changes when the data changes.
+        """
+        return content_hash(self.data)
+
     def __repr__(self):
         formatted_dict = pformat(dict(self.data))
         classname = self.__class__.__name__
@@ -26,6 +86,8 @@ class Collaborator(Model):
     """
     Implements a collaborator.
     """
+    __slots__ = ()
+
     def delete(self, project_id):
         """
         Deletes a collaborator from a shared project.
@@ -37,52 +99,66 @@ class CollaboratorState(Model):
     """
     Implements a collaborator state.
     """
-    pass
+    __slots__ = ()
 
 
 class Filter(Model):
     """
     Implements a filter.
     """
+    __slots__ = ()
+
     def update(self, **kwargs):
         """
         Updates filter.
         """
         self.api.filters.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.api.filters._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes filter.
         """
         self.api.filters.delete(self['id'])
-        self.data['is_deleted'] = 1
+        self.api.filters._update_local(self, {'is_deleted': 1})
 
 
 class Item(Model):
     """
     Implements an item.
     """
+    __slots__ = ()
+
+    date_fields = ('due_date_utc', 'date_added', 'completed_date')
+
+    @property
+    def due_timestamp(self):
+        return self.timestamp('due_date_utc')
+
+    @property
+    def due_datetime(self):
+        return self.datetime('due_date_utc')
+
     def update(self, **kwargs):
         """
         Updates item.
         """
         self.api.items.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.api.items._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes item.
         """
         self.api.items.delete([self['id']])
-        self.data['is_deleted'] = 1
+        self.api.items._update_local(self, {'is_deleted': 1})
 
     def move(self, to_project):
         """
         Moves item to another project.
         """
         self.api.items.move({self['project_id']: [self['id']]}, to_project)
-        self.data['project_id'] = to_project
+        self.api.items._update_local(self, {'project_id': to_project})
 
     def close(self):
         """
@@ -95,8 +171,8 @@ class Item(Model):
         Marks item as completed.
         """
         self.api.items.complete([self['id']], force_history)
-        self.data['checked'] = 1
-        self.data['in_history'] = force_history
+        self.api.items._update_local(self, {'checked': 1,
+                                            'in_history': force_history})
 
     def uncomplete(self, update_item_orders=1, restore_state=None):
         """
@@ -104,13 +180,13 @@ class Item(Model):
         """
         self.api.items.uncomplete([self['id']], update_item_orders,
                                   restore_state)
-        self.data['checked'] = 0
-        self.data['in_history'] = 0
+        data = {'checked': 0, 'in_history': 0}
         if restore_state and self['id'] in restore_state:
-            self.data['in_history'] = restore_state[self['id']][0]
-            self.data['checked'] = restore_state[self['id']][1]
-            self.data['item_order'] = restore_state[self['id']][2]
-            self.data['indent'] = restore_state[self['id']][3]
+            data['in_history'] = restore_state[self['id']][0]
+            data['checked'] = restore_state[self['id']][1]
+            data['item_order'] = restore_state[self['id']][2]
+            data['indent'] = restore_state[self['id']][3]
+        self.api.items._update_local(self, data)
 
     def update_date_complete(self, new_date_utc=None, date_string=None,
                              is_forward=None):
@@ -119,43 +195,51 @@ class Item(Model):
         """
         self.api.items.update_date_complete(self['id'], new_date_utc,
                                             date_string, is_forward)
+        data = {}
         if new_date_utc:
-            self.data['due_date_utc'] = new_date_utc
+            data['due_date_utc'] = new_date_utc
         if date_string:
-            self.data['date_string'] = date_string
+            data['date_string'] = date_string
+        self.api.items._update_local(self, data)
 
 
 class Label(Model):
     """
     Implements a label.
     """
+    __slots__ = ()
+
     def update(self, **kwargs):
         """
         Updates label.
         """
         self.api.labels.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.api.labels._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes label.
         """
         self.api.labels.delete(self['id'])
-        self.data['is_deleted'] = 1
+        self.api.labels._update_local(self, {'is_deleted': 1})
 
 
 class LiveNotification(Model):
     """
     Implements a live notification.
     """
-    pass
+    __slots__ = ()
 
 
 class GenericNote(Model):
     """
     Implements a note.
     """
-    #: has to be defined in subclasses
+    __slots__ = ()
+
+    date_fields = ('posted',)
+
+    #: has to be defined in subclasses, as a property
     local_manager = None
 
     def update(self, **kwargs):
@@ -163,65 +247,71 @@ class GenericNote(Model):
         Updates note.
         """
         self.local_manager.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.local_manager._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes note.
         """
         self.local_manager.delete(self['id'])
-        self.data['is_deleted'] = 1
+        self.local_manager._update_local(self, {'is_deleted': 1})
 
 
 class Note(GenericNote):
     """
     Implement an item note.
     """
-    def __init__(self, data, api):
-        GenericNote.__init__(self, data, api)
-        self.local_manager = self.api.notes
+    __slots__ = ()
+
+    @property
+    def local_manager(self):
+        return self.api.notes
 
 
 class ProjectNote(GenericNote):
     """
     Implement a project note.
     """
-    def __init__(self, data, api):
-        GenericNote.__init__(self, data, api)
-        self.local_manager = self.api.project_notes
+    __slots__ = ()
+
+    @property
+    def local_manager(self):
+        return self.api.project_notes
 
 
 class Project(Model):
     """
     Implements a project.
     """
+    __slots__ = ()
+
     def update(self, **kwargs):
         """
         Updates project.
         """
         self.api.projects.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.api.projects._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes project.
         """
         self.api.projects.delete([self['id']])
-        self.data['is_deleted'] = 1
+        self.api.projects._update_local(self, {'is_deleted': 1})
 
     def archive(self):
         """
         Marks project as archived.
         """
         self.api.projects.archive(self['id'])
-        self.data['is_archived'] = 1
+        self.api.projects._update_local(self, {'is_archived': 1})
 
     def unarchive(self):
         """
         Marks project as not archived.
         """
         self.api.projects.unarchive(self['id'])
-        self.data['is_archived'] = 0
+        self.api.projects._update_local(self, {'is_archived': 0})
 
     def share(self, email, message=''):
         """
@@ -240,16 +330,28 @@ class Reminder(Model):
     """
     Implements a reminder.
     """
+    __slots__ = ()
+
+    date_fields = ('due_date_utc',)
+
+    @property
+    def due_timestamp(self):
+        return self.timestamp('due_date_utc')
+
+    @property
+    def due_datetime(self):
+        return self.datetime('due_date_utc')
+
     def update(self, **kwargs):
         """
         Updates reminder.
         """
         self.api.reminders.update(self['id'], **kwargs)
-        self.data.update(kwargs)
+        self.api.reminders._update_local(self, kwargs)
 
     def delete(self):
         """
         Deletes reminder.
         """
         self.api.reminders.delete(self['id'])
-        self.data['is_deleted'] = 1
+        self.api.reminders._update_local(self, {'is_deleted': 1})
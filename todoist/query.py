@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+"""
+Local evaluation of Todoist filter queries, such as ``today | overdue``,
+``p1 & #Work`` or ``@waiting & !no date``, against the synced state.
+
+Queries are parsed once into a tree of terms and operators, and kept in a
+cache keyed by the query string.  Evaluation is planned so that the terms
+backed by an index of the items manager (priorities, labels, projects, due
+dates, full-text search) produce the candidate items, and the remaining terms
+are only checked against those candidates.
+"""
+import re
+import time
+import fnmatch
+import calendar
+import collections
+
+from . import dates
+from .indexes import count_terms, index_key
+
+
+class QueryError(Exception):
+    pass
+
+
+def parse(query):
+    """
+    Parses a filter query into a tree of terms, raising QueryError if the
+    query is not valid.  ``!`` binds tighter than ``&``, which binds tighter
+    than ``|``, and parentheses can be used for grouping.
+    """
+    tokens = [t.strip() for t in re.split(r'([&|!()])', query) if t.strip()]
+    node, pos = _parse_or(tokens, 0)
+    if pos != len(tokens):
+        raise QueryError('Unexpected %r in query %r' % (tokens[pos], query))
+    return node
+
+
+def _parse_or(tokens, pos):
+    children = []
+    node, pos = _parse_and(tokens, pos)
+    children.append(node)
+    while pos < len(tokens) and tokens[pos] == '|':
+        node, pos = _parse_and(tokens, pos + 1)
+        children.append(node)
+    return (children[0] if len(children) == 1 else Or(children)), pos
+
+
+def _parse_and(tokens, pos):
+    children = []
+    node, pos = _parse_not(tokens, pos)
+    children.append(node)
+    while pos < len(tokens) and tokens[pos] == '&':
+        node, pos = _parse_not(tokens, pos + 1)
+        children.append(node)
+    return (children[0] if len(children) == 1 else And(children)), pos
+
+
+def _parse_not(tokens, pos):
+    if pos >= len(tokens):
+        raise QueryError('Unexpected end of query')
+    if tokens[pos] == '!':
+        node, pos = _parse_not(tokens, pos + 1)
+        return Not(node), pos
+    if tokens[pos] == '(':
+        node, pos = _parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ')':
+            raise QueryError('Missing closing parenthesis')
+        return node, pos + 1
+    if tokens[pos] in '&|)':
+        raise QueryError('Unexpected %r' % tokens[pos])
+    return parse_term(tokens[pos]), pos + 1
+
+
+_DAYS = {'today': 0, 'tod': 0, 'tomorrow': 1, 'tom': 1, 'yesterday': -1}
+
+
+def parse_term(term):
+    """
+    Parses a single term of a filter query.
+    """
+    lower = term.lower()
+    if lower in ('all', 'view all'):
+        return All()
+    if lower in _DAYS or _DATE_RE.match(lower):
+        base, days = _parse_day(lower)
+        return Due((base, days), (base, days + 1))
+    if lower in ('overdue', 'od'):
+        return Overdue()
+    if lower in ('no date', 'no due date'):
+        return NoDate()
+    if lower == 'recurring':
+        return Recurring()
+    if lower == 'no priority':
+        return Priority(1)
+    if lower == 'no labels':
+        return NoLabels()
+    match = re.match(r'^(?:next )?(\d+) days?$', lower)
+    if match:
+        return Due((None, 0), (None, int(match.group(1))))
+    match = re.match(r'^due (before|after): *(.+)$', lower)
+    if match:
+        base, days = _parse_day(match.group(2))
+        if match.group(1) == 'before':
+            return Due(None, (base, days))
+        return Due((base, days + 1), None)
+    match = re.match(r'^p([1-4])$', lower)
+    if match:
+        return Priority(5 - int(match.group(1)))
+    if lower.startswith('search:'):
+        return Search(term[len('search:'):].strip())
+    if term.startswith('##'):
+        return Project(term[2:].strip(), subprojects=True)
+    if term.startswith('#'):
+        return Project(term[1:].strip())
+    if term.startswith('@'):
+        return Label(term[1:].strip())
+    raise QueryError('Unknown filter term %r' % term)
+
+
+_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+
+
+def _parse_day(value):
+    """
+    Parses a day as a (base, days) pair, where base is either None for today,
+    or the UTC timestamp of the midnight of a ``YYYY-MM-DD`` date.
+    """
+    if value in _DAYS:
+        return None, _DAYS[value]
+    match = _DATE_RE.match(value)
+    if match:
+        year, month, day = [int(v) for v in match.groups()]
+        return calendar.timegm((year, month, day, 0, 0, 0, 0, 0, 0)), 0
+    raise QueryError('Unknown date %r' % value)
+
+
+class Context(object):
+    """
+    State shared by the terms of a query while it is evaluated.
+    """
+    def __init__(self, engine, now=None):
+        self.engine = engine
+        self.items = engine.items
+        self.now = now or time.time()
+        self.offset = dates.user_offset(self.items.state['user'])
+        self.today = dates.day_start(self.now, self.offset)
+        self._universe = None
+
+    @property
+    def universe(self):
+        """
+        Returns the set of items that queries apply to, that is, the
+        uncompleted items which were not deleted.
+        """
+        if self._universe is None:
+            self._universe = set(item for item in self.items._indexes['checked'].get(0)
+                                 if is_active(item))
+        return self._universe
+
+    def day(self, day):
+        """
+        Returns the timestamp of the beginning of a day in the user's
+        timezone, given as a (base, days) pair.
+        """
+        base, days = day
+        if base is None:
+            base = self.today
+        else:
+            base -= self.offset
+        return base + days * dates.DAY
+
+
+def is_active(item):
+    return not (item.data.get('checked') or item.data.get('is_deleted') or
+                item.data.get('in_history'))
+
+
+class Node(object):
+    """
+    A term or operator of a query.
+    """
+    def lookup(self, ctx):
+        """
+        Returns the set of items matching the node by using the indexes, or
+        None if the node can only be checked item by item.
+        """
+        return None
+
+    def match(self, item, ctx):
+        raise NotImplementedError
+
+
+class And(Node):
+    def __init__(self, children):
+        self.children = children
+
+    def lookup(self, ctx):
+        sets, rest = [], []
+        for child in self.children:
+            objs = child.lookup(ctx)
+            if objs is None:
+                rest.append(child)
+            else:
+                sets.append(objs)
+        if not sets:
+            return None
+        sets.sort(key=len)
+        result = set(sets[0])
+        for objs in sets[1:]:
+            result &= objs
+        return set(item for item in result
+                   if all(child.match(item, ctx) for child in rest))
+
+    def match(self, item, ctx):
+        return all(child.match(item, ctx) for child in self.children)
+
+
+class Or(Node):
+    def __init__(self, children):
+        self.children = children
+
+    def lookup(self, ctx):
+        result = set()
+        for child in self.children:
+            objs = child.lookup(ctx)
+            if objs is None:
+                return None
+            result |= objs
+        return result
+
+    def match(self, item, ctx):
+        return any(child.match(item, ctx) for child in self.children)
+
+
+class Not(Node):
+    def __init__(self, child):
+        self.child = child
+
+    def lookup(self, ctx):
+        objs = self.child.lookup(ctx)
+        if objs is None:
+            return None
+        return ctx.universe - objs
+
+    def match(self, item, ctx):
+        return not self.child.match(item, ctx)
+
+
+class All(Node):
+    def lookup(self, ctx):
+        return set(ctx.universe)
+
+    def match(self, item, ctx):
+        return True
+
+
+class Due(Node):
+    """
+    Items due from the beginning of a day to the beginning of another one,
+    both given as (base, days) pairs, or None for an open range.
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def _range(self, ctx):
+        return (None if self.start is None else ctx.day(self.start),
+                None if self.end is None else ctx.day(self.end))
+
+    def lookup(self, ctx):
+        return set(ctx.items._indexes['due'].range(*self._range(ctx)))
+
+    def match(self, item, ctx):
+        due = item.due_timestamp
+        if due is None:
+            return False
+        start, end = self._range(ctx)
+        return (start is None or due >= start) and (end is None or due < end)
+
+
+class Overdue(Due):
+    def __init__(self):
+        Due.__init__(self, None, None)
+
+    def _range(self, ctx):
+        return None, ctx.now
+
+
+class NoDate(Node):
+    def match(self, item, ctx):
+        return not item.data.get('due_date_utc')
+
+
+class Recurring(Node):
+    def match(self, item, ctx):
+        return 'every' in (item.data.get('date_string') or '').lower()
+
+
+class Priority(Node):
+    def __init__(self, priority):
+        self.priority = priority
+
+    def lookup(self, ctx):
+        return set(ctx.items._indexes['priority'].get(self.priority))
+
+    def match(self, item, ctx):
+        return item.data.get('priority') == self.priority
+
+
+class NoLabels(Node):
+    def match(self, item, ctx):
+        return not item.data.get('labels')
+
+
+class Label(Node):
+    def __init__(self, name):
+        self.name = name
+
+    def lookup(self, ctx):
+        index = ctx.items._indexes['labels']
+        result = set()
+        for key in ctx.engine.label_keys(self.name):
+            result |= index.get(key)
+        return result
+
+    def match(self, item, ctx):
+        keys = ctx.engine.label_keys(self.name)
+        return any(index_key(label) in keys for label in item.data.get('labels') or ())
+
+
+class Project(Node):
+    def __init__(self, name, subprojects=False):
+        self.name = name
+        self.subprojects = subprojects
+
+    def lookup(self, ctx):
+        index = ctx.items._indexes['project_id']
+        result = set()
+        for key in ctx.engine.project_keys(self.name, self.subprojects):
+            result |= index.get(key)
+        return result
+
+    def match(self, item, ctx):
+        keys = ctx.engine.project_keys(self.name, self.subprojects)
+        return index_key(item.data.get('project_id')) in keys
+
+
+class Search(Node):
+    def __init__(self, text):
+        self.text = text
+        self.words = list(count_terms(text))
+
+    def lookup(self, ctx):
+        return set(ctx.items.search(self.text))
+
+    def match(self, item, ctx):
+        terms = count_terms(item.data.get('content') or '')
+        return all(any(term.startswith(word) for term in terms)
+                   for word in self.words)
+
+
+class QueryEngine(object):
+    """
+    Evaluates filter queries over the items of the local state, keeping the
+    parsed queries in a cache.
+    """
+    def __init__(self, items, cache_size=256):
+        self.items = items
+        self.cache_size = cache_size
+        self._queries = collections.OrderedDict()
+        self._names = {}
+
+    def compile(self, query):
+        """
+        Returns the parsed query, from the cache if it was already parsed.
+        """
+        node = self._queries.pop(query, None)
+        if node is None:
+            node = parse(query)
+        self._queries[query] = node
+        while len(self._queries) > self.cache_size:
+            self._queries.popitem(last=False)
+        return node
+
+    def evaluate(self, query, now=None):
+        """
+        Returns the uncompleted items matching the query, sorted by due date
+        and then by order.
+        """
+        result = list(self._evaluate(self.compile(query), Context(self, now)))
+        result.sort(key=_sort_key)
+        return result
+
+    def _evaluate(self, node, ctx):
+        """
+        Returns the set of uncompleted items matching a parsed query.
+        """
+        result = node.lookup(ctx)
+        if result is None:
+            return set(item for item in ctx.universe if node.match(item, ctx))
+        return set(item for item in result if is_active(item))
+
+    def _resolve(self, kind, manager, pattern, resolve):
+        """
+        Returns the keys of the objects whose name matches a pattern, which
+        are computed again whenever the objects of the manager change.
+        """
+        key = (kind, pattern.lower())
+        cached = self._names.get(key)
+        if cached is None or cached[0] != manager._generation:
+            cached = (manager._generation, resolve(pattern.lower()))
+            self._names[key] = cached
+        return cached[1]
+
+    def label_keys(self, name):
+        labels = self.items.api.labels
+
+        def resolve(pattern):
+            return frozenset(index_key(label['id']) for label in labels.all()
+                             if fnmatch.fnmatchcase(label['name'].lower(), pattern))
+        return self._resolve('label', labels, name, resolve)
+
+    def project_keys(self, name, subprojects=False):
+        projects = self.items.api.projects
+
+        def resolve(pattern):
+            keys = set()
+            for project in projects.all():
+                if fnmatch.fnmatchcase(project['name'].lower(), pattern):
+                    keys.add(index_key(project['id']))
+                    if subprojects:
+                        keys.update(index_key(p['id']) for p in
+                                    projects.get_descendants(project['id']))
+            return frozenset(keys)
+        return self._resolve('##' if subprojects else '#', projects, name, resolve)
+
+
+class QueryView(object):
+    """
+    Materialized view of the uncompleted items matching a query.
+
+    The matching items are computed once, and then only the items added,
+    updated or removed from the local state are checked again, as the items
+    manager reports them.  The view is computed from scratch only when the
+    query, the day, or the projects and labels it may refer to change, which
+    is detected when the view is read.  Subscribers are called with the lists
+    of items that entered and left the view.
+    """
+    def __init__(self, engine, query):
+        self.engine = engine
+        self._query = query  # query string, or function returning it
+        self._members = set()
+        self._touched = {}  # item -> whether it was in the view before
+        self._subscribers = []
+        self._node = None
+        self._ctx = None
+        self._key = None
+        self._stale = True
+        engine.items._watch(self)
+        self.refresh()
+
+    @property
+    def query(self):
+        return self._query() if callable(self._query) else self._query
+
+    def items(self, now=None):
+        """
+        Returns the items in the view, sorted by due date and then by order.
+        """
+        self.refresh(now)
+        return sorted(self._members, key=_sort_key)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def subscribe(self, callback):
+        """
+        Calls callback(added, removed) whenever items enter or leave the view.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def close(self):
+        """
+        Stops maintaining the view.
+        """
+        self.engine.items._unwatch(self)
+
+    def refresh(self, now=None):
+        """
+        Brings the view up to date with the current time, and with any
+        change of the query or of the projects and labels since it was last
+        computed.
+        """
+        ctx = Context(self.engine, now)
+        api = self.engine.items.api
+        query = self.query
+        key = (query, ctx.today, api.projects._generation, api.labels._generation)
+        if self._stale or key != self._key:
+            if self._key is None or query != self._key[0]:
+                self._node = self.engine.compile(query)
+            members = self.engine._evaluate(self._node, ctx)
+            for item in members ^ self._members:
+                self._touched.setdefault(item, item in self._members)
+            self._members = members
+        elif ctx.now > self._ctx.now:
+            # Within the same day, items only move in or out of the view
+            # because they became overdue since the last time.
+            for item in self.engine.items._indexes['due'].range(self._ctx.now, ctx.now):
+                self.remove(item)
+                self.add(item, ctx)
+        self._ctx = ctx
+        self._key = key
+        self._stale = False
+        self.flush()
+
+    def add(self, item, ctx=None):
+        if self._stale:
+            return
+        self._touched.setdefault(item, item in self._members)
+        if is_active(item) and self._node.match(item, ctx or self._ctx):
+            self._members.add(item)
+
+    def remove(self, item):
+        if self._stale:
+            return
+        self._touched.setdefault(item, item in self._members)
+        self._members.discard(item)
+
+    def reset(self):
+        self._stale = True
+
+    def flush(self):
+        """
+        Notifies the subscribers of the items which entered or left the view
+        since the last time.
+        """
+        touched, self._touched = self._touched, {}
+        added = [item for item, was_in in touched.items()
+                 if not was_in and item in self._members]
+        removed = [item for item, was_in in touched.items()
+                   if was_in and item not in self._members]
+        if added or removed:
+            for callback in list(self._subscribers):
+                callback(added, removed)
+
+
+def _sort_key(item):
+    due = item.due_timestamp
+    return (due is None, due or 0, item.data.get('item_order') or 0)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Tiered storage of the local state: the objects which are seldom needed, such
+as completed items and archived projects, are moved out of the in-memory
+state to a cold tier on disk, and brought back when they are asked for.
+"""
+import shelve
+import sys
+import time
+import weakref
+
+from . import dates
+
+
+def object_size(data):
+    """
+    Estimates the memory used by the data of an object, in bytes.  The keys
+    are left out, as they are shared by all the objects.
+    """
+    return sys.getsizeof(data) + sum(sys.getsizeof(value) for value in data.values())
+
+
+class TierPolicy(object):
+    """
+    Decides which objects of the local state are moved to the cold tier:
+    completed items and archived projects, once they were not changed for
+    idle_days.  If a memory_budget (in bytes) is given, they are only moved
+    while the estimated memory used by the local state exceeds it, starting
+    with the ones left untouched for the longest.
+
+    Subclasses can override is_cold() to move other objects, and changed_at()
+    to tell when they were last changed.
+    """
+    def __init__(self, idle_days=0, memory_budget=None):
+        self.idle_days = idle_days
+        self.memory_budget = memory_budget
+
+    def is_cold(self, datatype, obj):
+        if datatype == 'items':
+            return bool(obj.data.get('checked'))
+        if datatype == 'projects':
+            return bool(obj.data.get('is_archived'))
+        return False
+
+    def changed_at(self, datatype, obj):
+        """
+        Returns when an object which is cold was last changed, in seconds
+        since the epoch, if its data tells it (the completion date of items),
+        or None, in which case the time it was first found to be cold is
+        used, which is kept along with the cold tier.
+        """
+        if datatype == 'items':
+            return obj.timestamp('completed_date')
+        return None
+
+
+class ColdStore(object):
+    """
+    Keeps the data of objects on disk, in a shelve, by type of data and key.
+    The keys are also kept in memory, so that finding out whether an object
+    is in the store does not need to go to disk.
+
+    The store also keeps the times the objects of the local state were first
+    found to be cold, by type of data and key, in stamps.
+    """
+    stamps_name = 'stamps'  # unlike the names of the objects, without ':'
+
+    def __init__(self, path):
+        self.path = path
+        self._open('c')
+
+    def _open(self, flag):
+        self._db = shelve.open(self.path, flag, protocol=2)
+        self._keys = {}
+        self.stamps = self._db.get(self.stamps_name, {})
+        self.stamps_changed = False
+        for name in self._db.keys():
+            if name == self.stamps_name:
+                continue
+            datatype, key = name.split(':', 1)
+            self._keys.setdefault(datatype, set()).add(key)
+
+    def __contains__(self, datatype_key):
+        datatype, key = datatype_key
+        return key in self._keys.get(datatype, ())
+
+    def count(self, datatype):
+        return len(self._keys.get(datatype, ()))
+
+    def put(self, datatype, key, data):
+        self._db['%s:%s' % (datatype, key)] = data
+        self._keys.setdefault(datatype, set()).add(key)
+
+    def pop(self, datatype, key):
+        """
+        Removes the data of an object from the store and returns it, or
+        returns None if it is not there.
+        """
+        if (datatype, key) not in self:
+            return None
+        self._keys[datatype].discard(key)
+        return self._db.pop('%s:%s' % (datatype, key))
+
+    def values(self, datatype):
+        for key in list(self._keys.get(datatype, ())):
+            yield self._db['%s:%s' % (datatype, key)]
+
+    def clear(self):
+        self._db.close()
+        self._open('n')
+
+    def sync(self):
+        if self.stamps_changed:
+            self._db[self.stamps_name] = self.stamps
+            self.stamps_changed = False
+        self._db.sync()
+
+
+class _TierWatcher(object):
+    """
+    Keeps track of the estimated memory used by the objects of a type of data
+    in the local state, and of the ones the policy would move to the cold
+    tier, with the time they were last changed.
+    """
+    def __init__(self, datatype, policy, key, store):
+        self.datatype = datatype
+        self.policy = policy
+        self.key = key
+        self.store = store
+        self.reset()
+
+    def add(self, obj):
+        self.size += object_size(obj.data)
+        stamps = self.store.stamps.setdefault(self.datatype, {})
+        if self.policy.is_cold(self.datatype, obj):
+            touched = self.policy.changed_at(self.datatype, obj)
+            if touched is None:
+                key = self.key(obj)
+                touched = stamps.get(key)
+                if touched is None:
+                    touched = stamps[key] = time.time()
+                    self.store.stamps_changed = True
+            self.candidates[obj] = touched
+        elif stamps.pop(self.key(obj), None) is not None:
+            self.store.stamps_changed = True
+
+    def remove(self, obj):
+        self.size = max(0, self.size - object_size(obj.data))
+        self.candidates.pop(obj, None)
+
+    def flush(self):
+        pass
+
+    def reset(self):
+        self.size = 0
+        self.candidates = {}  # object -> time it was last changed
+
+
+class TieredStorage(object):
+    """
+    Moves the objects of the local state chosen by a policy to a cold store
+    after each update of the state, and brings them back on demand.  The
+    cache of the api keeps them along with the other objects, so that it
+    holds the whole state, whether or not it is read with tiering.
+    """
+    def __init__(self, api, policy, path):
+        self.api = weakref.proxy(api)
+        self.policy = policy
+        self.store = ColdStore(path)
+        self._watchers = {}
+        for datatype, _ in api._state_models:
+            manager = getattr(api, datatype)
+            watcher = self._watchers[datatype] = _TierWatcher(
+                datatype, policy, manager._object_key, self.store)
+            for obj in api.state[datatype]:
+                # The objects already in memory are more recent than the
+                # copies left in the cold tier, if any.
+                self.store.pop(datatype, manager._object_key(obj))
+                watcher.add(obj)
+            manager._watch(watcher)
+
+    def apply(self):
+        """
+        Moves the objects of the local state which are due to go to the cold
+        tier, and returns how many of them were moved, by type of data.
+        """
+        now = time.time()
+        idle = self.policy.idle_days * dates.DAY
+        budget = self.policy.memory_budget
+        total = sum(watcher.size for watcher in self._watchers.values())
+        candidates = []
+        if budget is None or total > budget:
+            for datatype, watcher in self._watchers.items():
+                for obj, touched in watcher.candidates.items():
+                    if now - touched >= idle and self._is_synced(obj):
+                        candidates.append((touched, datatype, obj))
+        if budget is not None:
+            candidates.sort(key=lambda candidate: candidate[0])
+
+        moved = {}
+        for _, datatype, obj in candidates:
+            if budget is not None and total <= budget:
+                break
+            total -= object_size(obj.data)
+            moved.setdefault(datatype, set()).add(obj)
+        for datatype, objs in moved.items():
+            manager = getattr(self.api, datatype)
+            for obj in objs:
+                manager._unindex(obj, tiering=True)
+                self.store.put(datatype, manager._object_key(obj), obj.data)
+            localobjs = self.api.state[datatype]
+            localobjs[:] = [obj for obj in localobjs if obj not in objs]
+            manager._notify_watchers()
+        # The stamps of the objects which are no longer candidates, having
+        # been moved or deleted, are dropped.
+        for datatype, watcher in self._watchers.items():
+            stamps = self.store.stamps.get(datatype, {})
+            if len(stamps) > len(watcher.candidates):
+                keys = set(watcher.key(obj) for obj in watcher.candidates)
+                for key in set(stamps) - keys:
+                    del stamps[key]
+                self.store.stamps_changed = True
+        if moved or self.store.stamps_changed:
+            self.store.sync()
+        return dict((datatype, len(objs)) for datatype, objs in moved.items())
+
+    def _is_synced(self, obj):
+        """
+        Returns whether the object has no local change which is yet to be
+        synced, and so can be moved.
+        """
+        return not (obj.data.get('is_deleted') or
+                    obj.temp_id in self.api._temp_id_objects)
+
+    def pop(self, datatype, key):
+        return self.store.pop(datatype, key)
+
+    def values(self, datatype):
+        return self.store.values(datatype)
+
+    def clear(self):
+        self.store.clear()
+
+    def memory_usage(self):
+        """
+        Returns the number of objects of each type of data in memory and in
+        the cold tier, and the estimated memory used by the former.
+        """
+        return dict((datatype, {'objects': len(self.api.state[datatype]),
+                                'bytes': watcher.size,
+                                'cold_objects': self.store.count(datatype)})
+                    for datatype, watcher in self._watchers.items())